@@ -0,0 +1,165 @@
+"""
+File: asyncstreaminginterpolators.py
+Author: Evan Smith
+Date Created: 10/16/26
+Date Last Modified: 10/16/26
+Python Version: 3.8+
+Description: asyncio front end for the streaming interpolators in
+             streaminginterpolators.py. Datapoints are queued without blocking
+             the event loop, coalesced into micro-batches and applied with
+             insertBatch on a worker thread, while queries are awaited.
+
+             async with AsyncStreamingInterpolator(LinearStreamingInterpolator()) as interpolator:
+                 await interpolator.put(1.0, 2.0)
+                 val = await interpolator.getInterpolatedVal(0.5)
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncStreamingInterpolator(object):
+    '''
+    Wraps a StreamingInterpolatorBase subclass for use from asyncio. put waits
+    while maxQueueSize datapoints are queued, which is the backpressure when
+    ingest outruns the inserts. A background task takes everything that is
+    queued, up to maxBatchSize datapoints, and applies it with one insertBatch.
+
+    Every call into the interpolator runs on one worker thread, so inserts and
+    queries never overlap and the event loop never blocks on them. A query sees
+    every datapoint put before it was made
+    '''
+
+    def __init__(self, interpolator, maxQueueSize=65536, maxBatchSize=4096):
+        '''
+        interpolator (StreamingInterpolatorBase) : the interpolator to feed, which
+            must not be used directly while this wraps it
+        maxQueueSize (int) : most datapoints queued before put waits
+        maxBatchSize (int) : most datapoints applied in one insertBatch
+        '''
+        self._interpolator = interpolator
+        self._maxBatchSize = maxBatchSize
+        self._queue = asyncio.Queue(maxQueueSize)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # number of datapoints put, and applied to the interpolator
+        self._putCount = 0
+        self._appliedCount = 0
+        self._applied = asyncio.Condition()
+        # exception raised by insertBatch, after which datapoints are discarded
+        self._error = None
+        self._task = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *excInfo):
+        await self.close()
+
+    def start(self):
+        ''' Start applying queued datapoints; needs a running event loop '''
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._applyBatches())
+
+    async def close(self):
+        ''' Wait for the queued datapoints to be applied, then stop '''
+        try:
+            if self._task is not None:
+                await self.flush()
+        finally:
+            if self._task is not None:
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+                self._task = None
+            self._executor.shutdown()
+
+    async def put(self, x, val):
+        '''
+        Queue a datapoint, waiting while the queue is full. Raises once
+        inserting into the interpolator has failed, even if it was waiting
+
+        x (float) : the x coordinate of the datapoint
+        val (float): the rest of the datapoint
+        '''
+        self._checkError()
+        await self._queue.put((x, val))
+        self._putCount += 1
+        self._checkError()
+
+    async def consume(self, source):
+        '''
+        Queue every datapoint of a source until it is exhausted
+
+        source (async iterable or asyncio.Queue) : (x, val) datapoints. A queue
+            is read until it gives None
+        '''
+        if hasattr(source, '__aiter__'):
+            async for x, val in source:
+                await self.put(x, val)
+        else:
+            while True:
+                item = await source.get()
+                if item is None:
+                    return
+                await self.put(*item)
+
+    async def flush(self):
+        ''' Wait until every datapoint put so far has been applied '''
+        target = self._putCount
+        async with self._applied:
+            await self._applied.wait_for(
+                lambda: self._appliedCount >= target or self._error is not None)
+        self._checkError()
+
+    async def getInterpolatedVal(self, x):
+        '''
+        Get the interpolated value for the given x
+
+        x : the x coordinate, as the interpolator takes it
+        returns (float) : interpolated value
+        '''
+        await self.flush()
+        return await self._run(self._interpolator.getInterpolatedVal, x)
+
+    async def getInterpolatedVals(self, xs):
+        '''
+        Get the interpolated values for a whole batch of x coordinates, for
+        interpolators that have getInterpolatedVals
+
+        xs (list of floats or numpy.ndarray) : the x coordinates
+        returns (numpy.ndarray) : interpolated values
+        '''
+        await self.flush()
+        return await self._run(self._interpolator.getInterpolatedVals, xs)
+
+    def _run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    def _checkError(self):
+        if self._error is not None:
+            raise RuntimeError('inserting into the interpolator failed') from self._error
+
+    async def _applyBatches(self):
+        '''
+        Apply queued datapoints in batches, for as long as the task runs. Once
+        an insertBatch fails, the queue is still drained but the datapoints are
+        discarded, so producers waiting on a full queue get to see the error
+        '''
+        while True:
+            # wait for a datapoint, then coalesce whatever else is queued
+            batch = [await self._queue.get()]
+            while len(batch) < self._maxBatchSize and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if self._error is None:
+                xs, vals = zip(*batch)
+                try:
+                    await self._run(self._interpolator.insertBatch, xs, vals)
+                except Exception as e:
+                    self._error = e
+            for _ in batch:
+                self._queue.task_done()
+            async with self._applied:
+                self._appliedCount += len(batch)
+                self._applied.notify_all()
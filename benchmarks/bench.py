@@ -0,0 +1,396 @@
+"""
+File: bench.py
+Author: Evan Smith
+Date Created: 10/16/26
+Date Last Modified: 10/16/26
+Python Version: 3.8+
+Description: Offline benchmark suite for brownian.py, streaminginterpolators.py
+             and kdtree. Every benchmark runs once per size and records some of
+             insert throughput, query latency percentiles and the memory high
+             water mark of building the structure (measured in a separate pass
+             with tracemalloc, so that tracing does not slow the timed pass).
+
+             python benchmarks/bench.py
+             python benchmarks/bench.py --only kdtree --baseline other.json
+             python benchmarks/bench.py --save-baseline benchmarks/baseline.json
+
+             Results are compared against benchmarks/baseline.json, the
+             committed reference run, unless another baseline or --no-baseline
+             is given. Every timing or memory metric that got worse by more than
+             the tolerance is listed, as is every benchmark that is missing from
+             the results or the baseline, and then the exit status is 1. After an
+             intended change, or on different hardware, regenerate the baseline
+             with --save-baseline and commit it along with the change.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from brownian import BrownianVariable, BrownianVariableHistory  # noqa: E402
+from streaminginterpolators import (KDTreeStreamingInterpolator,  # noqa: E402
+                                    LinearStreamingInterpolator,
+                                    NearestNeighborStreamingInterpolator,
+                                    SortedArrayHistory)
+import kdtree  # noqa: E402
+
+# name -> function(n, rng, nQueries) returning a dict of metrics
+BENCHMARKS = {}
+
+# metrics where a larger value is better; everything else is a cost
+HIGHER_IS_BETTER = ('itemsPerSec',)
+
+# timeThroughput repeats calls until they took this long in total, at most
+# MAX_REPEATS times
+MIN_TOTAL_SECONDS = 0.2
+MAX_REPEATS = 5
+
+# the committed reference results
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def benchmark(name):
+    ''' Registers a benchmark function under the given name '''
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def timeThroughput(func, n):
+    '''
+    Times a call that processes n items. Calls that take less than
+    MIN_TOTAL_SECONDS are repeated, up to MAX_REPEATS times, and the fastest
+    one counts, so that small sizes are not at the mercy of a single hiccup
+
+    func (function) : work to time, which must be safe to repeat
+    n (int) : number of items processed
+    returns (dict) : seconds and itemsPerSec
+    '''
+    seconds, total = float('inf'), 0.
+    for _ in range(MAX_REPEATS):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        seconds = min(seconds, elapsed)
+        total += elapsed
+        if total >= MIN_TOTAL_SECONDS:
+            break
+    return {'seconds': seconds, 'itemsPerSec': n / seconds if seconds else float('inf')}
+
+
+def timeLatencies(func, args):
+    '''
+    Times one call of func per argument
+
+    func (function) : query to time
+    args (list) : arguments, one per call
+    returns (dict) : p50Us, p90Us and p99Us latencies in microseconds
+    '''
+    latencies = numpy.empty(len(args))
+    clock = time.perf_counter
+    for i, arg in enumerate(args):
+        start = clock()
+        func(arg)
+        latencies[i] = clock() - start
+    p50, p90, p99 = numpy.percentile(latencies, [50, 90, 99]) * 1e6
+    return {'p50Us': p50, 'p90Us': p90, 'p99Us': p99}
+
+
+def measurePeak(func):
+    '''
+    Measures the memory high water mark of a call, as seen by tracemalloc
+
+    func (function) : work to measure
+    returns (dict) : peakBytes
+    '''
+    tracemalloc.start()
+    try:
+        func()
+        return {'peakBytes': tracemalloc.get_traced_memory()[1]}
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark('brownian.getValues')
+def benchBrownianGetValues(n, rng, nQueries):
+    ts = rng.uniform(0, n, n)
+    run = lambda: BrownianVariable(1.0, rng=0).getValues(ts)
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('brownian.insertData')
+def benchBrownianInsertData(n, rng, nQueries):
+    ts, vals = numpy.arange(n, dtype=float).tolist(), rng.normal(size=n).tolist()
+
+    def run():
+        history = BrownianVariableHistory()
+        for t, val in zip(ts, vals):
+            history.insertData(t, val)
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('brownian.getMartingaleRelevantPoints')
+def benchBrownianQuery(n, rng, nQueries):
+    history = BrownianVariableHistory()
+    build = lambda: history.insertDataBatch(numpy.arange(n, dtype=float), rng.normal(size=n))
+    metrics = measurePeak(build)
+    metrics.update(timeLatencies(history.getMartingaleRelevantPoints,
+                                 rng.uniform(-1, n, nQueries).tolist()))
+    return metrics
+
+
+@benchmark('brownian.getValue')
+def benchBrownianGetValue(n, rng, nQueries):
+    variable = BrownianVariable(1.0, rng=0)
+    variable.getValues(numpy.arange(1, n, dtype=float))
+    return timeLatencies(variable.getValue, rng.uniform(0, n, nQueries).tolist())
+
+
+def buildInterpolator(cls, n, rng, history=None):
+    interpolator = cls(history)
+    for x, val in zip(numpy.arange(n, dtype=float).tolist(), rng.normal(size=n).tolist()):
+        interpolator.insert(x, val)
+    return interpolator
+
+
+@benchmark('streaminginterpolators.linear.insert')
+def benchLinearInsert(n, rng, nQueries):
+    run = lambda: buildInterpolator(LinearStreamingInterpolator, n, rng)
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('streaminginterpolators.linear.insert.sortedArray')
+def benchLinearArrayInsert(n, rng, nQueries):
+    run = lambda: buildInterpolator(LinearStreamingInterpolator, n, rng, SortedArrayHistory())
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('streaminginterpolators.linear.getInterpolatedVal')
+def benchLinearQuery(n, rng, nQueries):
+    interpolator = buildInterpolator(LinearStreamingInterpolator, n, rng)
+    return timeLatencies(interpolator.getInterpolatedVal, rng.uniform(-1, n, nQueries).tolist())
+
+
+@benchmark('streaminginterpolators.linear.getInterpolatedVals')
+def benchLinearBatchQuery(n, rng, nQueries):
+    interpolator = buildInterpolator(LinearStreamingInterpolator, n, rng)
+    xs = rng.uniform(-1, n, n)
+    run = lambda: interpolator.getInterpolatedVals(xs)
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('streaminginterpolators.nearest.getInterpolatedVal')
+def benchNearestQuery(n, rng, nQueries):
+    interpolator = buildInterpolator(NearestNeighborStreamingInterpolator, n, rng)
+    return timeLatencies(interpolator.getInterpolatedVal, rng.uniform(-1, n, nQueries).tolist())
+
+
+def randomPoints(n, rng, dimensions=3):
+    return [tuple(p) for p in rng.uniform(0, 1, (n, dimensions)).tolist()]
+
+
+def buildKDTreeInterpolator(points, rng):
+    interpolator = KDTreeStreamingInterpolator(len(points[0]))
+    for point, val in zip(points, rng.normal(size=len(points)).tolist()):
+        interpolator.insert(point, val)
+    return interpolator
+
+
+@benchmark('streaminginterpolators.kdtree.insert')
+def benchKDTreeInterpolatorInsert(n, rng, nQueries):
+    points = randomPoints(n, rng, 2)
+    run = lambda: buildKDTreeInterpolator(points, rng)
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('streaminginterpolators.kdtree.insert.line')
+def benchKDTreeInterpolatorInsertLine(n, rng, nQueries):
+    # sorted along x with a constant y, the worst case for keeping balance
+    points = [(x, 0.0) for x in numpy.arange(n, dtype=float).tolist()]
+    run = lambda: buildKDTreeInterpolator(points, rng)
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('kdtree.create')
+def benchKDTreeCreate(n, rng, nQueries):
+    points = randomPoints(n, rng)
+    run = lambda: kdtree.create(list(points))
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('kdtree.add')
+def benchKDTreeAdd(n, rng, nQueries):
+    points = randomPoints(n, rng)
+
+    def run():
+        tree = kdtree.create(dimensions=3)
+        for point in points:
+            tree.add(point)
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('kdtree.search_knn')
+def benchKDTreeSearchKnn(n, rng, nQueries):
+    tree = kdtree.create(randomPoints(n, rng))
+    return timeLatencies(lambda point: tree.search_knn(point, 10), randomPoints(nQueries, rng))
+
+
+@benchmark('kdtree.search_nn')
+def benchKDTreeSearchNn(n, rng, nQueries):
+    tree = kdtree.create(randomPoints(n, rng))
+    return timeLatencies(tree.search_nn, randomPoints(nQueries, rng))
+
+
+@benchmark('kdtree.static.create')
+def benchStaticKDTreeCreate(n, rng, nQueries):
+    points = randomPoints(n, rng)
+    run = lambda: kdtree.StaticKDTree(points)
+    return dict(timeThroughput(run, n), **measurePeak(run))
+
+
+@benchmark('kdtree.static.query')
+def benchStaticKDTreeQuery(n, rng, nQueries):
+    tree = kdtree.StaticKDTree(randomPoints(n, rng))
+    points = rng.uniform(0, 1, (nQueries, 3))
+    return timeThroughput(lambda: tree.query(points, 10, workers=1), nQueries)
+
+
+@benchmark('kdtree.static.query_radius')
+def benchStaticKDTreeQueryRadius(n, rng, nQueries):
+    tree = kdtree.StaticKDTree(randomPoints(n, rng))
+    points = rng.uniform(0, 1, (nQueries, 3))
+    # about 10 points within the radius of a query inside the unit cube
+    distance = (30 / (4 * numpy.pi * n)) ** (1 / 3.)
+    return timeThroughput(lambda: tree.query_radius(points, distance, workers=1), nQueries)
+
+
+@benchmark('kdtree.bucket.search_knn')
+def benchBucketKDTreeSearchKnn(n, rng, nQueries):
+    tree = kdtree.BucketKDTree(randomPoints(n, rng))
+    return timeLatencies(lambda point: tree.search_knn(point, 10), randomPoints(nQueries, rng))
+
+
+def runBenchmarks(names, sizes, nQueries, seed):
+    '''
+    Runs the named benchmarks at every size
+
+    names (list of str) : benchmark names
+    sizes (list of int) : sizes
+    nQueries (int) : most queries timed by a latency benchmark
+    seed (int) : random seed, so every run sees the same data
+    returns (dict) : "name[n=size]" -> metrics
+    '''
+    results = {}
+    for name in names:
+        for n in sizes:
+            key = '%s[n=%d]' % (name, n)
+            metrics = BENCHMARKS[name](n, numpy.random.default_rng(seed), min(n, nQueries))
+            results[key] = metrics
+            print('%-62s %s' % (key, '  '.join('%s=%.4g' % kv for kv in sorted(metrics.items()))))
+            sys.stdout.flush()
+    return results
+
+
+def compareToBaseline(results, baseline, tolerance, memoryTolerance):
+    '''
+    Finds the metrics that got worse than the baseline by more than the tolerance,
+    and the results that are missing from either side, such as those of a
+    renamed or dropped benchmark
+
+    results (dict) : "name[n=size]" -> metrics
+    baseline (dict) : "name[n=size]" -> metrics, of the benchmarks and sizes
+        that were run
+    tolerance (float) : allowed relative slowdown
+    memoryTolerance (float) : allowed relative growth of peakBytes
+    returns (list of str) : descriptions of the regressions
+    '''
+    regressions = []
+    for key in sorted(set(baseline) - set(results)):
+        regressions.append('%s: missing from the results' % key)
+    for key in sorted(set(results) - set(baseline)):
+        regressions.append('%s: missing from the baseline' % key)
+    for key in sorted(set(results) & set(baseline)):
+        for metric, old in sorted(baseline[key].items()):
+            new = results[key].get(metric)
+            if new is None or metric in HIGHER_IS_BETTER or not old:
+                continue
+            allowed = memoryTolerance if metric == 'peakBytes' else tolerance
+            if new > old * (1 + allowed):
+                regressions.append('%s %s: %.4g -> %.4g (+%.0f%%)' % (
+                    key, metric, old, new, 100. * (new - old) / old))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('Description:')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', default='',
+                        help='comma separated benchmark name prefixes, e.g. kdtree,brownian')
+    parser.add_argument('--sizes', default='1e2,1e3,1e4,1e5,1e6,1e7',
+                        help='comma separated sizes (default: %(default)s)')
+    parser.add_argument('--max-size', type=float, default=1e5,
+                        help='skip sizes above this; use 1e7 for the full sweep (default: 1e5)')
+    parser.add_argument('--queries', type=int, default=2000,
+                        help='queries timed per latency benchmark (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json',
+                        help='where to write the results as JSON (default: %(default)s)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='results JSON to compare against (default: %(default)s)')
+    parser.add_argument('--no-baseline', action='store_true',
+                        help='only record the results, without comparing them')
+    parser.add_argument('--save-baseline', help='also write the results to this path')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown (default: %(default)s)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.10,
+                        help='allowed relative memory growth (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    prefixes = [p for p in args.only.split(',') if p]
+    names = [name for name in BENCHMARKS
+             if not prefixes or any(name.startswith(p) for p in prefixes)]
+    sizes = [int(float(size)) for size in args.sizes.split(',')
+             if float(size) <= args.max_size]
+
+    output = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seed': args.seed,
+        },
+        'results': runBenchmarks(names, sizes, args.queries, args.seed),
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(output, f, indent=2, sort_keys=True)
+
+    if not args.no_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        # only what was selected to run has to be in the results
+        baseline = {key: metrics for key, metrics in baseline.items()
+                    if (not prefixes or any(key.startswith(p) for p in prefixes))
+                    and int(key.split('[n=')[1].rstrip(']')) in sizes}
+        regressions = compareToBaseline(output['results'], baseline, args.tolerance,
+                                        args.memory_tolerance)
+        if regressions:
+            print('\nREGRESSIONS against %s:' % args.baseline)
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('\nNo regressions against %s' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
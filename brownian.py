@@ -2,20 +2,237 @@
 File: brownian.py
 Author: Evan Smith
 Date Created: 10/17/15
-Date Last Modified: 10/22/15
-Python Version: 2.7.10
+Date Last Modified: 10/16/26
+Python Version: 3.8+
 Description: Several statistical functions and classes used to efficiently
              handle continuous Brownian variables
 """
-from scipy.stats import norm
-from bintrees import RBTree
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple, OrderedDict
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing.shared_memory import SharedMemory
+import numpy
+import os
+
+
+def _bracketSorted(times, ts):
+    '''
+    Finds the left and right neighbors of each of ts among sorted times. See
+    BrownianVariableHistory.bracket
+
+    times (numpy.ndarray) : sorted, unique times
+    ts (numpy.ndarray) : times to bracket
+    returns (numpy.ndarray, numpy.ndarray) : indices of the left and right neighbors,
+        -1 where there is none
+    '''
+    leftIdxs = numpy.searchsorted(times, ts, 'right') - 1
+    rightIdxs = numpy.searchsorted(times, ts, 'left')
+    return leftIdxs, numpy.where(rightIdxs < len(times), rightIdxs, -1)
 
 
 class BrownianVariableHistory(object):
-    ''' Represents the set of known time value pairs for a particular Brownian variable '''
+    '''
+    Represents the set of known time value pairs for a particular Brownian variable.
+    The pairs are stored in sorted, contiguous float64 arrays with spare capacity
+    at the end, so appending in time order is amortized O(1). Points inserted out
+    of order one at a time are buffered and merged into the arrays in bulk.
+
+    A history created by fork() shares the points of its parent as read only
+    base segments and only stores the points that come after the end of them.
+    A fork of a fork shares the segments of its parent plus the parent's own
+    points, so nested forks never copy the common points. The segments are
+    copied the first time the fork inserts a point inside them.
+
+    A history opened by load() maps its arrays straight from a file written by
+    save(), either read only or for appending points after the last one.
+
+    The bridge parameters of the gaps between points that getBridge was most
+    recently asked about are kept in an LRU cache of gapCacheSize gaps
+    '''
+
+    # smallest number of buffered out of order points that triggers a merge
+    _MIN_PENDING = 4096
+
+    # a history file starts with _HEADER_WORDS little endian uint64 words: the
+    # magic bytes, the format version, the number of points and the capacity.
+    # They are followed by the time column and then the value column, each
+    # holding capacity little endian float64s
+    _FILE_MAGIC = b'BRWNHIST'
+    _FILE_VERSION = 1
+    _HEADER_WORDS = 8
 
-    def __init__(self):
-        self._historyTree = RBTree()
+    def __init__(self, gapCacheSize=1024):
+        self._times = numpy.empty(16)
+        self._vals = numpy.empty(16)
+        self._size = 0
+        # sorted out of order points, none of which are in the arrays
+        self._pendingTimes = []
+        self._pendingVals = []
+        # (times, vals) segments shared with the ancestors of a fork, in time
+        # order and all before the points above, and the last time of each
+        self._bases = []
+        self._baseLastTimes = []
+        # true while a fork may be reading the arrays, which must then be copied
+        # before any point in them is modified
+        self._shared = False
+        # path, open mode and mapped header of a history opened by load()
+        self._path = None
+        self._mode = None
+        self._header = None
+        # left time -> BrownianBridge of cached gaps, least recently used first
+        self._gapCache = OrderedDict()
+        self._gapCacheKeys = []
+        self._gapCacheSize = gapCacheSize
+
+    def __len__(self):
+        return self._getBaseSize() + self._size + len(self._pendingTimes)
+
+    def fork(self):
+        '''
+        Creates a copy-on-write copy of the history. The fork shares all points
+        currently in this history without copying them, and inserts into either
+        history are not seen by the other. Forking takes O(number of nested
+        forks) time, whatever the number of points. A fork of a history file
+        opened with mode 'r+' gets a copy of the points, since growing the file
+        moves the values to a new place in it
+
+        returns (BrownianVariableHistory) : history object
+        '''
+        self._flush()
+        fork = BrownianVariableHistory(self._gapCacheSize)
+        fork._bases = list(self._bases)
+        fork._baseLastTimes = list(self._baseLastTimes)
+        if self._size:
+            if self._mode == 'r+':
+                segment = (self._getReadOnly(self._times[:self._size].copy()),
+                           self._getReadOnly(self._vals[:self._size].copy()))
+            else:
+                segment = (self._getReadOnly(self._times), self._getReadOnly(self._vals))
+                self._shared = True
+            fork._bases.append(segment)
+            fork._baseLastTimes.append(float(segment[0][-1]))
+        return fork
+
+    def clone(self):
+        '''
+        Creates a copy of the history that shares no memory with it
+
+        returns (BrownianVariableHistory) : history object
+        '''
+        clone = BrownianVariableHistory(self._gapCacheSize)
+        clone._merge(self.getTimes(), self.getVals())
+        return clone
+
+    def save(self, path):
+        '''
+        Writes the history to a file holding a small header followed by the sorted
+        times and the values as float64 columns, which load() can map back. The
+        file is written next to path and then moved over it, so histories mapped
+        from the old file keep working. A history loaded from path itself only
+        flushes its mapped file
+
+        path (str) : file path
+        '''
+        if self._header is not None and os.path.exists(path) and \
+                os.path.samefile(path, self._path):
+            if self._mode == 'r+':
+                self._header.flush()
+                if isinstance(self._times, numpy.memmap):
+                    self._times.flush()
+            return
+
+        times, vals = self.getTimes(), self.getVals()
+        header = numpy.zeros(self._HEADER_WORDS, dtype='<u8')
+        header[:4] = (numpy.frombuffer(self._FILE_MAGIC, dtype='<u8')[0],
+                      self._FILE_VERSION, len(times), len(times))
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmpPath, 'wb') as f:
+                header.tofile(f)
+                times.astype('<f8').tofile(f)
+                vals.astype('<f8').tofile(f)
+            os.replace(tmpPath, path)
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+    @classmethod
+    def load(cls, path, mode='r'):
+        '''
+        Opens a history file written by save() without reading it into memory.
+        With mode 'r' the history is read only, and with mode 'r+' points after
+        the last one can be inserted and are written straight to the file. Use
+        clone() on the result to get an ordinary in memory history
+
+        path (str) : file path
+        mode (str) : 'r' or 'r+'
+        returns (BrownianVariableHistory) : history object
+        '''
+        if mode not in ('r', 'r+'):
+            raise ValueError('History files can only be opened with mode r or r+')
+        history = cls()
+        history._path = path
+        history._mode = mode
+        history._mapFile()
+        return history
+
+    def _mapFile(self):
+        ''' Maps the header and columns of the history file '''
+        header = numpy.memmap(self._path, dtype='<u8', mode=self._mode,
+                              shape=(self._HEADER_WORDS,))
+        if header[0] != numpy.frombuffer(self._FILE_MAGIC, dtype='<u8')[0] or \
+                header[1] != self._FILE_VERSION:
+            raise ValueError('%s is not a Brownian history file' % self._path)
+        self._header = header
+        self._size, capacity = int(header[2]), int(header[3])
+        if capacity:
+            columns = numpy.memmap(self._path, dtype='<f8', mode=self._mode,
+                                   offset=8 * self._HEADER_WORDS, shape=(2, capacity))
+            self._times, self._vals = columns[0], columns[1]
+        else:
+            self._times, self._vals = numpy.empty(0), numpy.empty(0)
+
+    def _growFile(self, capacity):
+        '''
+        Grows the columns of the history file, moving the values to their new offset
+
+        capacity (int) : number of points
+        '''
+        oldCapacity = len(self._times)
+        self._times = self._vals = None
+        with open(self._path, 'r+b') as f:
+            f.truncate(8 * (self._HEADER_WORDS + 2 * capacity))
+        columns = numpy.memmap(self._path, dtype='<f8', mode='r+',
+                               offset=8 * self._HEADER_WORDS, shape=(2 * capacity,))
+        columns[capacity:capacity + self._size] = \
+            columns[oldCapacity:oldCapacity + self._size]
+        columns.flush()
+        del columns
+        self._header[3] = capacity
+        self._mapFile()
+
+    def _checkWritable(self, t, val=None):
+        '''
+        Makes sure a point can be written to the file of a loaded history, which
+        only accepts points after its last one
+
+        t (float) : earliest time being inserted
+        val (float) : its value, if it is a single point
+        returns (bool) : true if the point is already in the file
+        '''
+        if self._header is None:
+            return False
+        if self._mode == 'r':
+            raise ValueError('History file %s is opened read only' % self._path)
+        if self._size and t <= self._times[self._size - 1]:
+            i = numpy.searchsorted(self._times[:self._size], t)
+            if self._times[i] == t and self._vals[i] == val:
+                return True
+            raise ValueError('History file %s can only be appended to' % self._path)
+        return False
 
     def insertData(self, t, val):
         '''
@@ -24,7 +241,58 @@ class BrownianVariableHistory(object):
         t (float) : time
         val (float) : value
         '''
-        self._historyTree.insert(t, val)
+        t, val = float(t), float(val)
+        if self._checkWritable(t, val):
+            return
+        if self._gapCache:
+            self._evictGaps([t])
+        if self._bases and t <= self._baseLastTimes[-1]:
+            self._materialize()
+        if self._size == 0 or t > self._times[self._size - 1]:
+            self._reserve(self._size + 1)
+            self._times[self._size] = t
+            self._vals[self._size] = val
+            self._size += 1
+            self._syncHeader()
+            return
+
+        i = numpy.searchsorted(self._times[:self._size], t)
+        if self._times[i] == t:
+            self._unshare()
+            self._vals[i] = val
+            return
+
+        i = bisect_left(self._pendingTimes, t)
+        if i < len(self._pendingTimes) and self._pendingTimes[i] == t:
+            self._pendingVals[i] = val
+            return
+        self._pendingTimes.insert(i, t)
+        self._pendingVals.insert(i, val)
+        if len(self._pendingTimes) >= max(self._MIN_PENDING, int(self._size**0.5)):
+            self._flush()
+
+    def insertDataBatch(self, ts, vals):
+        '''
+        Inserts many data points into the history object with a single merge.
+        If a time is given more than once, the last value given for it is kept
+
+        ts (list of floats or numpy.ndarray) : times
+        vals (list of floats or numpy.ndarray) : values
+        '''
+        ts = numpy.asarray(ts, dtype=float).ravel()
+        vals = numpy.asarray(vals, dtype=float).ravel()
+        if not len(ts):
+            return
+        order = numpy.argsort(ts, kind='stable')
+        ts, vals = ts[order], vals[order]
+        isLast = numpy.append(ts[1:] != ts[:-1], True)
+        self._checkWritable(ts[0])
+        if self._gapCache:
+            self._evictGaps(ts)
+        self._flush()
+        if self._bases and ts[0] <= self._baseLastTimes[-1]:
+            self._materialize()
+        self._merge(ts[isLast], vals[isLast])
 
     def getMartingaleRelevantPoints(self, t):
         '''
@@ -41,29 +309,379 @@ class BrownianVariableHistory(object):
         Ex: bh.getMartingaleRelevantPoints(3.1) == ((3.0, 0.07), (3.5, 0.21))
             bh.getMartingaleRelevantPoints(3.6) == ((3.5, 0.21), None)
         '''
-        if self._historyTree.is_empty():
-            return None, None
+        if self._bases and t <= self._baseLastTimes[-1]:
+            # the first segment that reaches t holds its right neighbor, and
+            # the left one unless t is before all of its points
+            k = bisect_left(self._baseLastTimes, t)
+            leftPoint, rightPoint = self._getSortedNeighbors(self._bases[k][0],
+                                                             self._bases[k][1], t)
+            if leftPoint is None and k > 0:
+                leftPoint = self._getLastBasePoint(k - 1)
+            return leftPoint, rightPoint
+
+        leftPoint, rightPoint = self._getSortedNeighbors(
+            self._times[:self._size], self._vals[:self._size], t)
+        if leftPoint and leftPoint[0] == t:
+            return leftPoint, rightPoint
+
+        # the buffered points can only be closer, since they are not in the arrays
+        i = bisect_right(self._pendingTimes, t)
+        if i > 0 and (leftPoint is None or self._pendingTimes[i - 1] > leftPoint[0]):
+            leftPoint = (self._pendingTimes[i - 1], self._pendingVals[i - 1])
+            if leftPoint[0] == t:
+                return leftPoint, leftPoint
+        if i < len(self._pendingTimes) and \
+                (rightPoint is None or self._pendingTimes[i] < rightPoint[0]):
+            rightPoint = (self._pendingTimes[i], self._pendingVals[i])
+
+        if leftPoint is None and self._bases:
+            leftPoint = self._getLastBasePoint(len(self._bases) - 1)
+        return leftPoint, rightPoint
+
+    def _getLastBasePoint(self, k):
+        '''
+        k (int) : index of a base segment
+        returns ((t,val)) : the last data point of the segment
+        '''
+        times, vals = self._bases[k]
+        return float(times[-1]), float(vals[-1])
+
+    def _getBaseSize(self):
+        ''' returns (int) : number of points in the base segments '''
+        return sum(len(times) for times, _ in self._bases)
+
+    def getBridge(self, t, cache=True):
+        '''
+        Gets the Brownian bridge across the gap between the two data points that
+        enclose t. Recently used gaps are found without searching the history,
+        and inserting into a gap only evicts that gap from the cache
+
+        t (float) : time
+        cache (bool) : true if a gap that is not cached yet should be cached
+        returns (BrownianBridge) : bridge, or None if t is in the history or is
+            not between two data points
+        '''
+        i = bisect_right(self._gapCacheKeys, t) - 1
+        if i >= 0:
+            bridge = self._gapCache[self._gapCacheKeys[i]]
+            if bridge.leftT < t < bridge.rightT:
+                self._gapCache.move_to_end(bridge.leftT)
+                return bridge
+
+        leftDataPoint, rightDataPoint = self.getMartingaleRelevantPoints(t)
+        if not (leftDataPoint and rightDataPoint) or leftDataPoint[0] == t:
+            return None
+        bridge = BrownianBridge.fromPoints(leftDataPoint, rightDataPoint)
+        if cache and self._gapCacheSize > 0:
+            if len(self._gapCache) >= self._gapCacheSize:
+                leftT, _ = self._gapCache.popitem(last=False)
+                del self._gapCacheKeys[bisect_left(self._gapCacheKeys, leftT)]
+            self._gapCache[bridge.leftT] = bridge
+            insort(self._gapCacheKeys, bridge.leftT)
+        return bridge
+
+    def _evictGaps(self, ts):
+        '''
+        Evicts the cached gaps that inserting the given times would split or
+        whose ends would change value
+
+        ts (list of floats or numpy.ndarray) : sorted times
+        '''
+        # the cached gaps do not overlap, so a time can only touch the gap with
+        # the last left time not after it, and the one before that if the
+        # time is its right end
+        keys = self._gapCacheKeys
+        if len(ts) == 1:
+            idxs = [bisect_right(keys, ts[0]) - 1]
+        else:
+            idxs = numpy.unique(numpy.searchsorted(keys, ts, 'right') - 1).tolist()
+        candidates = set(idxs) | set(i - 1 for i in idxs)
+
+        # delete from the back, so the remaining indices stay valid
+        for i in sorted(candidates, reverse=True):
+            if i < 0:
+                continue
+            bridge = self._gapCache[keys[i]]
+            j = bisect_left(ts, bridge.leftT) if len(ts) == 1 else \
+                numpy.searchsorted(ts, bridge.leftT)
+            if j < len(ts) and ts[j] <= bridge.rightT:
+                del self._gapCache[keys[i]]
+                del keys[i]
+
+    @staticmethod
+    def _getSortedNeighbors(times, vals, t):
+        '''
+        Finds the neighbors of t among sorted times, see getMartingaleRelevantPoints
 
+        times (numpy.ndarray) : sorted times
+        vals (numpy.ndarray) : values
+        t (float) : time
+        returns ((t1,val1), (t2,val2)) : 2 data points
+        '''
         leftPoint = None
         rightPoint = None
-        if self._historyTree.min_key() <= t:
-            leftPoint = self._historyTree.floor_item(t)
-        if self._historyTree.max_key() >= t:
-            rightPoint = self._historyTree.ceiling_item(t)
+        i = numpy.searchsorted(times, t, 'right')
+        if i > 0:
+            leftPoint = (float(times[i - 1]), float(vals[i - 1]))
+            if leftPoint[0] == t:
+                return leftPoint, leftPoint
+        if i < len(times):
+            rightPoint = (float(times[i]), float(vals[i]))
         return leftPoint, rightPoint
 
+    def bracket(self, ts):
+        '''
+        Finds the neighbors of a whole batch of times at once. For each time, the
+        left neighbor is the data point with the largest 't' that is not larger
+        than it, and the right neighbor is the data point with the smallest 't'
+        that is not smaller than it, so a time that is in the history is its own
+        left and right neighbor
+
+        ts (numpy.ndarray) : times
+        returns (numpy.ndarray, numpy.ndarray) : indices into getTimes() and
+            getVals() of the left and right neighbors, -1 where there is none
+
+        Ex: if bh.getTimes() == [2.5, 3.0, 3.5]
+            bh.bracket([3.1, 3.6]) == ([1, 2], [2, -1])
+        '''
+        self._flush()
+        if not self._bases:
+            return _bracketSorted(self._times[:self._size], ts)
+
+        # bracket every time within the first segment that reaches it, or the
+        # own points after all segments. A left neighbor missing from a segment
+        # is the last point of the one before
+        ts = numpy.asarray(ts, dtype=float)
+        segments = self._bases + [(self._times[:self._size], None)]
+        segmentIdxs = numpy.searchsorted(self._baseLastTimes, ts)
+        leftIdxs = numpy.empty(ts.shape, dtype=int)
+        rightIdxs = numpy.empty(ts.shape, dtype=int)
+        offset = 0
+        for k, (times, _) in enumerate(segments):
+            inSegment = segmentIdxs == k
+            segmentLeftIdxs, segmentRightIdxs = _bracketSorted(times, ts[inSegment])
+            leftIdxs[inSegment] = segmentLeftIdxs + offset
+            rightIdxs[inSegment] = numpy.where(segmentRightIdxs >= 0,
+                                               segmentRightIdxs + offset, -1)
+            offset += len(times)
+        return leftIdxs, rightIdxs
+
+    def getPoints(self, idxs):
+        '''
+        Gets the data points at the given positions in time order, such as the
+        indices returned by bracket. Unlike getTimes and getVals, this never
+        copies the shared points of a fork
+
+        idxs (numpy.ndarray) : indices
+        returns (numpy.ndarray, numpy.ndarray) : times and values
+        '''
+        self._flush()
+        if not self._bases:
+            return self._times[:self._size][idxs], self._vals[:self._size][idxs]
+
+        idxs = numpy.asarray(idxs) % len(self)
+        times = numpy.empty(idxs.shape)
+        vals = numpy.empty(idxs.shape)
+        offset = 0
+        for segmentTimes, segmentVals in self._bases + [(self._times[:self._size],
+                                                         self._vals[:self._size])]:
+            inSegment = (idxs >= offset) & (idxs < offset + len(segmentTimes))
+            times[inSegment] = segmentTimes[idxs[inSegment] - offset]
+            vals[inSegment] = segmentVals[idxs[inSegment] - offset]
+            offset += len(segmentTimes)
+        return times, vals
+
+    def getTimes(self):
+        '''
+        Gets a read only view of the sorted times in the history. For a fork
+        that still shares points with its parent, this is a read only copy
+
+        returns (numpy.ndarray) : times
+        '''
+        self._flush()
+        return self._getReadOnly(self._times, 0)
+
+    def getVals(self):
+        '''
+        Gets a read only view of the values in the history, in time order. For a
+        fork that still shares points with its parent, this is a read only copy
+
+        returns (numpy.ndarray) : values
+        '''
+        self._flush()
+        return self._getReadOnly(self._vals, 1)
+
+    def _getReadOnly(self, arr, baseColumn=None):
+        view = arr[:self._size]
+        if baseColumn is not None and self._bases:
+            view = numpy.concatenate([base[baseColumn] for base in self._bases] + [view])
+        view.flags.writeable = False
+        return view
+
+    def _reserve(self, capacity):
+        '''
+        Makes sure the arrays can hold at least the given number of points,
+        at least doubling their capacity whenever they have to grow
+
+        capacity (int) : number of points
+        '''
+        if capacity <= len(self._times):
+            return
+        capacity = max(capacity, 2 * len(self._times))
+        if self._header is not None:
+            self._growFile(capacity)
+            return
+        for name in ('_times', '_vals'):
+            arr = numpy.empty(capacity)
+            arr[:self._size] = getattr(self, name)[:self._size]
+            setattr(self, name, arr)
+        self._shared = False
+
+    def _unshare(self):
+        ''' Copies the arrays if a fork may be reading them, before they are modified '''
+        if self._shared:
+            self._times, self._vals = self._times.copy(), self._vals.copy()
+            self._shared = False
+
+    def _materialize(self):
+        ''' Copies the shared base segments of a fork into its own arrays '''
+        if not self._bases:
+            return
+        baseSize = self._getBaseSize()
+        capacity = baseSize + len(self._times)
+        for column, name in enumerate(('_times', '_vals')):
+            arr = numpy.empty(capacity)
+            numpy.concatenate([base[column] for base in self._bases], out=arr[:baseSize])
+            arr[baseSize:baseSize + self._size] = getattr(self, name)[:self._size]
+            setattr(self, name, arr)
+        self._bases, self._baseLastTimes = [], []
+        self._size += baseSize
+        self._shared = False
+
+    def _flush(self):
+        ''' Merges the buffered out of order points into the arrays '''
+        if self._pendingTimes:
+            ts, vals = numpy.array(self._pendingTimes), numpy.array(self._pendingVals)
+            self._pendingTimes, self._pendingVals = [], []
+            self._merge(ts, vals)
+
+    def _merge(self, ts, vals):
+        '''
+        Merges points into the arrays in O(n + m). There must be no buffered
+        points, and no shared base unless every point comes after it
+
+        ts (numpy.ndarray) : sorted, unique times
+        vals (numpy.ndarray) : values
+        '''
+        times = self._times[:self._size]
+        idxs = numpy.searchsorted(times, ts)
+        exists = idxs < self._size
+        exists[exists] = times[idxs[exists]] == ts[exists]
+        if exists.any():
+            self._unshare()
+            self._vals[idxs[exists]] = vals[exists]
+        ts, vals, idxs = ts[~exists], vals[~exists], idxs[~exists]
+        if not len(ts):
+            return
+
+        newSize = self._size + len(ts)
+        if idxs[0] == self._size:
+            # everything goes after the last point
+            self._reserve(newSize)
+            self._times[self._size:newSize] = ts
+            self._vals[self._size:newSize] = vals
+        else:
+            newIdxs = idxs + numpy.arange(len(ts))
+            isOld = numpy.ones(newSize, dtype=bool)
+            isOld[newIdxs] = False
+            capacity = max(newSize, len(self._times))
+            for name, new in (('_times', ts), ('_vals', vals)):
+                arr = numpy.empty(capacity)
+                arr[newIdxs] = new
+                arr[:newSize][isOld] = getattr(self, name)[:self._size]
+                setattr(self, name, arr)
+            self._shared = False
+        self._size = newSize
+        self._syncHeader()
+
+    def _syncHeader(self):
+        ''' Records the number of points in the file of a loaded history '''
+        if self._header is not None:
+            self._header[2] = self._size
+
+
+class BrownianDistribution(namedtuple('BrownianDistribution', ['mean', 'standardDev'])):
+    ''' Normal distribution of the value of a Brownian variable at a single time '''
+    __slots__ = ()
+
+    def sample(self, rng):
+        '''
+        Draws a value from the distribution
+
+        rng (numpy.random.Generator) : random number generator
+        returns (float) : value
+        '''
+        return self.mean + self.standardDev * rng.standard_normal()
+
+    def toScipyDistr(self):
+        '''
+        Gets the equivalent scipy distribution object. scipy.stats is only
+        imported the first time this is called
+
+        returns (scipy.stats.rv_continuous) : probability distribution
+        '''
+        from scipy.stats import norm
+        return norm(loc=self.mean, scale=self.standardDev)
+
+
+class BrownianBridge(namedtuple('BrownianBridge',
+                                ['leftT', 'leftVal', 'rightT', 'rightVal', 'slope'])):
+    ''' Brownian bridge across the gap between two known data points '''
+    __slots__ = ()
+
+    @classmethod
+    def fromPoints(cls, leftDataPoint, rightDataPoint):
+        '''
+        Creates the bridge between two data points
+
+        leftDataPoint ((float, float)) : earlier (t, val) data point
+        rightDataPoint ((float, float)) : later (t, val) data point
+        returns (BrownianBridge) : bridge
+        '''
+        (leftT, leftVal), (rightT, rightVal) = leftDataPoint, rightDataPoint
+        return cls(leftT, leftVal, rightT, rightVal, (rightVal - leftVal) / (rightT - leftT))
+
+    def getDistribution(self, t, sigma):
+        '''
+        Gets the value probability distribution at a time inside the gap. This is
+        the closed form of BrownianVariable._getSandwichDistribution, in which
+        the drift cancels out
+
+        t (float) : time
+        sigma (float) : standard deviation
+        returns (BrownianDistribution) : probability distribution
+        '''
+        return BrownianDistribution(
+            self.leftVal + (t - self.leftT) * self.slope,
+            sigma * ((t - self.leftT) * (self.rightT - t) / (self.rightT - self.leftT))**0.5)
+
 
 class BrownianVariable(object):
     ''' Random variable that has a Brownian motion '''
 
-    def __init__(self, sigma, startTime=0, startVal=0, drift=0, history=BrownianVariableHistory()):
+    def __init__(self, sigma, startTime=0, startVal=0, drift=0, history=None, rng=None):
         self._sigma = sigma
         self._sigmastartTime = startTime
         self._startVal = startVal
         self._drift = drift
-        self._history = history
-        # add the seed point into the history
-        self._history.insertData(startTime, startVal)
+        # each variable owns its history unless it is explicitly given one
+        self._history = history if history is not None else BrownianVariableHistory()
+        # accepts a numpy.random.Generator, or anything default_rng can seed from
+        self._rng = numpy.random.default_rng(rng)
+        # add the seed point into the history, unless it already has a value for startTime
+        leftDataPoint, _ = self._history.getMartingaleRelevantPoints(startTime)
+        if not leftDataPoint or leftDataPoint[0] != startTime:
+            self._history.insertData(startTime, startVal)
 
     def getHistory(self):
         '''
@@ -74,13 +692,53 @@ class BrownianVariable(object):
         '''
         return self._history
 
+    def fork(self, rng=None):
+        '''
+        Creates a scenario branch of the variable: a variable with the same parameters
+        whose history is a copy-on-write fork of this variable's history, so the
+        branch sees everything observed so far without copying it
+
+        rng (numpy.random.Generator, int or None) : random number generator or seed for
+            the branch, spawned from this variable's generator if None
+        returns (BrownianVariable) : variable
+        '''
+        branch = copy.copy(self)
+        branch._history = self._history.fork()
+        branch._rng = self._rng.spawn(1)[0] if rng is None else numpy.random.default_rng(rng)
+        return branch
+
     def getPossibleValueDistr(self, t):
         '''
-        Gets a scipy distribution object representing the pdf of the brownian value at a given t
+        Gets a scipy distribution object representing the pdf of the brownian value at a given t.
+        getPossibleValueParams is much cheaper if only the mean and standard deviation are needed
 
         t (float) : time
         returns (scipy.stats.rv_continuous) : probability distribution
         '''
+        return self.getPossibleValueParams(t).toScipyDistr()
+
+    def getPossibleValueParams(self, t):
+        '''
+        Gets the mean and standard deviation of the normal pdf of the brownian value at a given t
+
+        t (float) : time
+        returns (BrownianDistribution) : probability distribution
+        '''
+        return self._getPossibleValueParams(t, True)
+
+    def _getPossibleValueParams(self, t, cacheGap):
+        '''
+        See getPossibleValueParams
+
+        t (float) : time
+        cacheGap (bool) : true if the gap t falls in should be cached, which is
+            wasted work if a point at t is about to be inserted into it
+        returns (BrownianDistribution) : probability distribution
+        '''
+        bridge = self._history.getBridge(t, cacheGap)
+        if bridge:
+            return bridge.getDistribution(t, self._sigma)
+
         leftDataPoint, rightDataPoint = self._history.getMartingaleRelevantPoints(t)
         if not (leftDataPoint or rightDataPoint):
             # should only happen if the history invariant has been violated
@@ -90,13 +748,13 @@ class BrownianVariable(object):
         if leftDataPoint:
             prevT, prevVal = leftDataPoint
             if prevT == t:
-                return norm(loc=prevVal, scale=0)
+                return BrownianDistribution(prevVal, 0.0)
 
         futrT, futrVal = None, None
         if rightDataPoint:
             futrT, futrVal = rightDataPoint
             if futrT == t:
-                return norm(loc=futrVal, scale=0)
+                return BrownianDistribution(futrVal, 0.0)
 
         mean, standardDev = None, None
         if not rightDataPoint:
@@ -113,7 +771,7 @@ class BrownianVariable(object):
             # brownian variable sometime in between
             mean, standardDev = self._getSandwichDistribution(
                 t, prevT, prevVal, futrT, futrVal, self._sigma, self._drift)
-        return norm(loc=mean, scale=standardDev)
+        return BrownianDistribution(mean, standardDev)
 
     @staticmethod
     def _getSandwichDistribution(t, baseTLeft, baseValLeft, baseTRight, baseValRight, sigma, drift):
@@ -170,23 +828,424 @@ class BrownianVariable(object):
         storeInHistory (bool) : true if the generated value should be inserted into the history
         returns (float) : value
         '''
-        distr = self.getPossibleValueDistr(t)
-        val = distr.rvs()
+        val = self._getPossibleValueParams(t, not storeInHistory).sample(self._rng)
         if storeInHistory:
             self._history.insertData(t, val)
         return val
 
-    def getValues(self, tList):
+    def getValues(self, tList, storeInHistory=True):
+        '''
+        Gets values of the brownian variable for all times listed in tList. All
+        of the times are drawn together, one vectorized pass per kind of gap in
+        the history, which gives the same joint distribution as calling
+        getValue for each time in sorted order
+
+        tList (list of floats or numpy.ndarray) : list of times
+        storeInHistory (bool) : true if the generated values should be inserted into the history
+        returns (numpy.ndarray) : values, in the same order as tList
+        '''
+        ts, inverse = numpy.unique(
+            numpy.asarray(tList, dtype=float), return_inverse=True)
+        vals = self._getSortedValues(ts, storeInHistory)
+        return vals[inverse].reshape(numpy.shape(tList))
+
+    def iterValues(self, tIter, chunkSize=65536, storeInHistory=False):
+        '''
+        Generates values of the brownian variable chunk by chunk along a non-decreasing
+        grid of times of any length. Unless storeInHistory is true, nothing is added
+        to the history and the only state kept between chunks is the last generated
+        point, so memory use does not grow with the length of the grid
+
+        tIter (iterable of floats, or numpy.ndarray) : non-decreasing times
+        chunkSize (int) : number of times per chunk
+        storeInHistory (bool) : true if the generated values should be inserted into the history
+        yields (numpy.ndarray, numpy.ndarray) : a chunk of times and their values
+        '''
+        lastT, lastVal = None, None
+        for ts in self._iterChunks(tIter, chunkSize):
+            if (ts[1:] < ts[:-1]).any() or (lastT is not None and ts[0] < lastT):
+                raise ValueError('Times must be non-decreasing')
+            if storeInHistory:
+                lastT = ts[-1]
+                yield ts, self.getValues(ts)
+                continue
+
+            uniqueTs, inverse = numpy.unique(ts, return_inverse=True)
+            leftTs, leftVals, rightTs, rightVals = self._getBracketingPoints(
+                self._history, uniqueTs)
+            if lastT is not None:
+                # the last generated point is closer than any earlier history point
+                isAfterLast = ~(leftTs >= lastT)
+                leftTs[isAfterLast], leftVals[isAfterLast] = lastT, lastVal
+            vals = self._getSampledValues(uniqueTs, leftTs, leftVals, rightTs, rightVals,
+                                          self._sigma, self._drift, self._rng.standard_normal)
+            lastT, lastVal = uniqueTs[-1], vals[-1]
+            yield ts, vals[inverse.ravel()]
+
+    @staticmethod
+    def _iterChunks(tIter, chunkSize):
+        '''
+        Splits times into float64 arrays of at most chunkSize times
+
+        tIter (iterable of floats, or numpy.ndarray) : times
+        chunkSize (int) : number of times per chunk
+        yields (numpy.ndarray) : times
+        '''
+        if isinstance(tIter, numpy.ndarray):
+            tIter = tIter.ravel()
+            for start in range(0, len(tIter), chunkSize):
+                yield numpy.asarray(tIter[start:start + chunkSize], dtype=float)
+            return
+        tIter = iter(tIter)
+        while True:
+            ts = numpy.fromiter(islice(tIter, chunkSize), dtype=float)
+            if not len(ts):
+                return
+            yield ts
+
+    def _getSortedValues(self, ts, storeInHistory):
+        '''
+        Gets values of the brownian variable for sorted, unique times
+
+        ts (numpy.ndarray) : sorted, unique times
+        storeInHistory (bool) : true if the generated values should be inserted into the history
+        returns (numpy.ndarray) : values
+        '''
+        leftTs, leftVals, rightTs, rightVals = self._getBracketingPoints(self._history, ts)
+        vals = self._getSampledValues(ts, leftTs, leftVals, rightTs, rightVals,
+                                      self._sigma, self._drift,
+                                      self._rng.standard_normal)
+        if storeInHistory:
+            # times already in the history keep their values
+            isNew = leftTs != ts
+            self._history.insertDataBatch(ts[isNew], vals[isNew])
+        return vals
+
+    @staticmethod
+    def _getBracketingPoints(history, ts):
+        '''
+        Finds the history points enclosing each of the given times
+
+        history (BrownianVariableHistory or BrownianEnsembleHistory) : history object
+        ts (numpy.ndarray) : sorted, unique times
+        returns (numpy.ndarray x 4) : left times, left values, right times and
+            right values, with nan wherever a neighbor does not exist. The values
+            have one row per path for an ensemble history
+        '''
+        if not len(history):
+            # should only happen if the history invariant has been violated
+            raise Exception('Brownian History Corruption Error')
+
+        leftIdxs, rightIdxs = history.bracket(ts)
+        leftTs, leftVals = history.getPoints(leftIdxs)
+        rightTs, rightVals = history.getPoints(rightIdxs)
+        hasLeft, hasRight = leftIdxs >= 0, rightIdxs >= 0
+        return (numpy.where(hasLeft, leftTs, numpy.nan),
+                numpy.where(hasLeft, leftVals, numpy.nan),
+                numpy.where(hasRight, rightTs, numpy.nan),
+                numpy.where(hasRight, rightVals, numpy.nan))
+
+    @staticmethod
+    def _getSampledValues(ts, leftTs, leftVals, rightTs, rightVals, sigma, drift, standardNormal):
+        '''
+        Samples a Brownian variable at many times given the reference points
+        enclosing each time. Times matching a reference point take its value,
+        times before the first reference point are walked backward from it,
+        times after the last one are walked forward from it, and the remaining
+        times are bridged between their two reference points
+
+        ts (numpy.ndarray) : sorted, unique times
+        leftTs (numpy.ndarray) : left reference time of each t, nan if there is none
+        leftVals (numpy.ndarray) : left reference value of each t, shape (..., len(ts))
+        rightTs (numpy.ndarray) : right reference time of each t, nan if there is none
+        rightVals (numpy.ndarray) : right reference value of each t, shape (..., len(ts))
+        sigma (float) : standard deviation
+        drift (float) : drift rate
+        standardNormal (function) : draws an array of standard normals of the given shape
+        returns (numpy.ndarray) : values, shape (..., len(ts))
+        '''
+        vals = numpy.empty(numpy.broadcast(leftVals, rightVals).shape)
+        leadShape = vals.shape[:-1]
+
+        exact = leftTs == ts
+        backward = numpy.isnan(leftTs)
+        forward = numpy.isnan(rightTs)
+        bridged = ~(exact | backward | forward)
+        vals[..., exact] = leftVals[..., exact]
+
+        if backward.any():
+            # run back the clock from the earliest reference point
+            idxs = numpy.flatnonzero(backward)[::-1]
+            vals[..., idxs] = BrownianVariable._getWalkValues(
+                ts[idxs], rightTs[idxs[0]], rightVals[..., idxs[0]], sigma, drift,
+                standardNormal(leadShape + (len(idxs),)))
+        if forward.any():
+            idxs = numpy.flatnonzero(forward)
+            vals[..., idxs] = BrownianVariable._getWalkValues(
+                ts[idxs], leftTs[idxs[0]], leftVals[..., idxs[0]], sigma, drift,
+                standardNormal(leadShape + (len(idxs),)))
+        if bridged.any():
+            vals[..., bridged] = BrownianVariable._getBridgeValues(
+                ts[bridged], leftTs[bridged], leftVals[..., bridged],
+                rightTs[bridged], rightVals[..., bridged], sigma, standardNormal)
+        return vals
+
+    @staticmethod
+    def _getWalkValues(ts, baseT, baseVal, sigma, drift, normals):
+        '''
+        Samples a Brownian path leading away from a single reference point by
+        chaining _getDistribution from each time to the next
+
+        ts (numpy.ndarray) : times, ordered by increasing distance from baseT
+        baseT (float) : reference point time
+        baseVal (float or numpy.ndarray) : reference point value, one per path
+        sigma (float) : standard deviation
+        drift (float) : drift rate
+        normals (numpy.ndarray) : standard normal draws, shape (..., len(ts))
+        returns (numpy.ndarray) : values, shape (..., len(ts))
+        '''
+        steps = numpy.diff(ts, prepend=baseT)
+        means, standardDevs = BrownianVariable._getDistribution(
+            steps, 0, 0, sigma, drift)
+        return numpy.asarray(baseVal)[..., None] + numpy.cumsum(
+            means + standardDevs * normals, axis=-1)
+
+    @staticmethod
+    def _getBridgeValues(ts, leftTs, leftVals, rightTs, rightVals, sigma, standardNormal):
+        '''
+        Samples Brownian bridges across gaps between reference points. This is
+        the vectorized form of repeatedly applying _getSandwichDistribution to
+        the times of a gap in sorted order: a driftless path is walked through
+        each gap, then shifted linearly so that it lands on the right reference
+        point, which is where the drift cancels out
+
+        ts (numpy.ndarray) : sorted times, each strictly inside its gap
+        leftTs (numpy.ndarray) : left reference time of each t
+        leftVals (numpy.ndarray) : left reference value of each t, shape (..., len(ts))
+        rightTs (numpy.ndarray) : right reference time of each t
+        rightVals (numpy.ndarray) : right reference value of each t, shape (..., len(ts))
+        sigma (float) : standard deviation
+        standardNormal (function) : draws an array of standard normals of the given shape
+        returns (numpy.ndarray) : values, shape (..., len(ts))
+        '''
+        isGapStart = numpy.ones(len(ts), dtype=bool)
+        isGapStart[1:] = leftTs[1:] != leftTs[:-1]
+        gapStarts = numpy.flatnonzero(isGapStart)
+        gapEnds = numpy.append(gapStarts[1:], len(ts)) - 1
+        gapIdxs = numpy.cumsum(isGapStart) - 1
+        leadShape = numpy.broadcast(leftVals, rightVals).shape[:-1]
+
+        # walk each gap from zero at its left reference point
+        prevTs = numpy.where(isGapStart, leftTs, numpy.roll(ts, 1))
+        steps = sigma * (ts - prevTs)**0.5 * standardNormal(leadShape + (len(ts),))
+        walk = numpy.cumsum(steps, axis=-1)
+        walk -= (walk - steps)[..., gapStarts][..., gapIdxs]
+        walkEnds = walk[..., gapEnds] + sigma * (rightTs[gapEnds] - ts[gapEnds])**0.5 \
+            * standardNormal(leadShape + (len(gapStarts),))
+
+        # pin every walk to its right reference point
+        pin = (ts - leftTs) / (rightTs - leftTs)
+        return leftVals + walk + pin * (rightVals - leftVals - walkEnds[..., gapIdxs])
+
+
+class BrownianEnsembleHistory(object):
+    '''
+    Represents the set of known time value pairs for many paths of a Brownian
+    variable that are all known at the same times. The times are stored in a
+    sorted float64 array and the values in an (nPaths x nTimes) float64 array
+    '''
+
+    def __init__(self, nPaths):
+        self._times = numpy.empty(0)
+        self._vals = numpy.empty((nPaths, 0))
+
+    def __len__(self):
+        return len(self._times)
+
+    def getNumPaths(self):
+        '''
+        Gets the number of paths in the history
+
+        returns (int) : number of paths
         '''
-        Gets values of the brownian variable for all times listed in tList
+        return self._vals.shape[0]
 
-        tList (list of floats) : list of times
-        returns (list of floats) : values
+    def insertDataBatch(self, ts, vals):
         '''
-        # Let's sort for optimal performance creating the distribtions
-        sortedIdxs = [e[0]
-                      for e in sorted(enumerate(tList), key=lambda x: x[1])]
-        retVals = [None] * len(tList)
-        for i in sortedIdxs:
-            retVals[i] = self.getValue(tList[i], storeInHistory=True)
-        return retVals
+        Inserts the values of every path at many times with a single merge. If a
+        time is given more than once, the last values given for it are kept
+
+        ts (list of floats or numpy.ndarray) : times
+        vals (numpy.ndarray) : values, shape (nPaths, len(ts))
+        '''
+        ts = numpy.asarray(ts, dtype=float).ravel()
+        vals = numpy.asarray(vals, dtype=float).reshape(self.getNumPaths(), len(ts))
+        if not len(ts):
+            return
+        order = numpy.argsort(ts, kind='stable')
+        isLast = numpy.append(ts[order][1:] != ts[order][:-1], True)
+        ts, vals = ts[order][isLast], vals[:, order[isLast]]
+
+        idxs = numpy.searchsorted(self._times, ts)
+        exists = idxs < len(self._times)
+        exists[exists] = self._times[idxs[exists]] == ts[exists]
+        self._vals[:, idxs[exists]] = vals[:, exists]
+        self._times = numpy.insert(self._times, idxs[~exists], ts[~exists])
+        self._vals = numpy.insert(self._vals, idxs[~exists], vals[:, ~exists], axis=1)
+
+    def bracket(self, ts):
+        '''
+        Finds the neighbors of a whole batch of times at once. See
+        BrownianVariableHistory.bracket
+
+        ts (numpy.ndarray) : times
+        returns (numpy.ndarray, numpy.ndarray) : indices into getTimes() and the
+            columns of getVals() of the left and right neighbors, -1 where there is none
+        '''
+        return _bracketSorted(self._times, ts)
+
+    def getPoints(self, idxs):
+        '''
+        Gets the data points at the given positions in time order, such as the
+        indices returned by bracket
+
+        idxs (numpy.ndarray) : indices
+        returns (numpy.ndarray, numpy.ndarray) : times, and values with shape (nPaths, len(idxs))
+        '''
+        return self._times[idxs], self._vals[:, idxs]
+
+    def getTimes(self):
+        '''
+        Gets a read only view of the sorted times in the history
+
+        returns (numpy.ndarray) : times
+        '''
+        view = self._times[:]
+        view.flags.writeable = False
+        return view
+
+    def getVals(self):
+        '''
+        Gets a read only view of the values in the history
+
+        returns (numpy.ndarray) : values, shape (nPaths, nTimes)
+        '''
+        view = self._vals[:]
+        view.flags.writeable = False
+        return view
+
+
+class BrownianEnsemble(object):
+    '''
+    Many independent paths of a random variable that has a Brownian motion,
+    which are all refined at the same times together
+    '''
+
+    def __init__(self, nPaths, sigma, startTime=0, startVal=0, drift=0, rng=None):
+        self._sigma = sigma
+        self._drift = drift
+        self._history = BrownianEnsembleHistory(nPaths)
+        self._rng = numpy.random.default_rng(rng)
+        # add the seed point, which may differ per path, into the history
+        self._history.insertDataBatch(
+            [startTime], numpy.broadcast_to(numpy.reshape(startVal, (-1, 1)), (nPaths, 1)))
+
+    def getNumPaths(self):
+        '''
+        Gets the number of paths in the ensemble
+
+        returns (int) : number of paths
+        '''
+        return self._history.getNumPaths()
+
+    def getHistory(self):
+        '''
+        Gets a reference to the underlying history object containing all observed values
+        of the paths
+
+        returns BrownianEnsembleHistory : history object
+        '''
+        return self._history
+
+    def getValues(self, tList, storeInHistory=True):
+        '''
+        Gets values of every path for all times listed in tList, sampling all
+        paths together in the same way as BrownianVariable.getValues
+
+        tList (list of floats or numpy.ndarray) : list of times
+        storeInHistory (bool) : true if the generated values should be inserted into the history
+        returns (numpy.ndarray) : values, shape (nPaths, len(tList)), with the
+            columns in the same order as tList
+        '''
+        ts, inverse = numpy.unique(
+            numpy.asarray(tList, dtype=float), return_inverse=True)
+        leftTs, leftVals, rightTs, rightVals = BrownianVariable._getBracketingPoints(
+            self._history, ts)
+        vals = BrownianVariable._getSampledValues(
+            ts, leftTs, leftVals, rightTs, rightVals, self._sigma, self._drift,
+            self._rng.standard_normal)
+        if storeInHistory:
+            self._history.insertDataBatch(ts, vals)
+        return vals[:, inverse.ravel()].reshape((self.getNumPaths(),) + numpy.shape(tList))
+
+
+def generatePaths(nPaths, tList, sigma, startTime=0, startVal=0, drift=0, seed=None,
+                  maxWorkers=None, shardSize=1024):
+    '''
+    Generates independent paths of a Brownian variable at the given times using a
+    pool of processes. The paths are split into shards of shardSize paths, and each
+    shard is drawn as a BrownianEnsemble seeded by its own SeedSequence spawned
+    from seed, so the result depends only on seed and shardSize and is the same
+    for any number of workers. Workers read the times from and write their paths
+    into a single shared memory block instead of pickling them back
+
+    nPaths (int) : number of paths
+    tList (list of floats or numpy.ndarray) : list of times
+    sigma (float) : standard deviation
+    startTime (float) : time of the seed point
+    startVal (float or numpy.ndarray) : value of the seed point, optionally one per path
+    drift (float) : drift rate
+    seed (int, numpy.random.SeedSequence or None) : root seed
+    maxWorkers (int or None) : number of processes, defaults to the number of CPUs
+    shardSize (int) : number of paths drawn together by one task
+    returns (numpy.ndarray) : values, shape (nPaths, len(tList))
+    '''
+    ts = numpy.asarray(tList, dtype=float).ravel()
+    startVals = numpy.broadcast_to(numpy.reshape(startVal, (-1,)), (nPaths,))
+    if not isinstance(seed, numpy.random.SeedSequence):
+        seed = numpy.random.SeedSequence(seed)
+    shardStarts = range(0, nPaths, shardSize)
+    shardSeeds = seed.spawn(len(shardStarts))
+
+    # the block holds the times followed by the paths
+    shm = SharedMemory(create=True, size=max(8 * len(ts) * (nPaths + 1), 1))
+    try:
+        numpy.ndarray(len(ts), buffer=shm.buf)[:] = ts
+        with ProcessPoolExecutor(maxWorkers) as executor:
+            futures = [executor.submit(_generatePathShard, shm.name, len(ts), start,
+                                       min(start + shardSize, nPaths), sigma, startTime,
+                                       startVals[start:start + shardSize], drift, shardSeed)
+                       for start, shardSeed in zip(shardStarts, shardSeeds)]
+            for future in futures:
+                future.result()
+        return numpy.ndarray((nPaths, len(ts)), buffer=shm.buf, offset=8 * len(ts)).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _generatePathShard(shmName, nTimes, start, stop, sigma, startTime, startVal,
+                       drift, seed):
+    '''
+    Worker for generatePaths: draws paths start to stop into the shared memory block
+    '''
+    shm = SharedMemory(name=shmName)
+    try:
+        # no views into the block may outlive it, so nothing here keeps one
+        ts = numpy.ndarray(nTimes, buffer=shm.buf).copy()
+        ensemble = BrownianEnsemble(stop - start, sigma, startTime, startVal, drift, rng=seed)
+        numpy.ndarray((stop - start, nTimes), buffer=shm.buf,
+                      offset=8 * nTimes * (start + 1))[:] = ensemble.getValues(
+                          ts, storeInHistory=False)
+    finally:
+        shm.close()
@@ -1 +1,3 @@
-from kdtree import *
+from .kdtree import *
+from .static import StaticKDTree
+from .bucket import BucketKDTree
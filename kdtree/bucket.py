@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+
+"""A kd-tree with leaf buckets
+Instead of one point per node, the leaves of the tree hold up to bucket_size
+points each in a contiguous array, so reaching the points takes far fewer
+Python objects and levels, and the distances to all points of a leaf are
+computed in one NumPy step. Points can be added and removed like with KDNode;
+a leaf that overflows is split at the median of its widest axis.
+"""
+
+import heapq
+
+import numpy
+
+
+class Leaf(object):
+    """ A leaf of a BucketKDTree, holding its points in the first size rows of
+    the points array """
+
+    def __init__(self, points, capacity):
+        self.size = len(points)
+        self.points = numpy.empty((max(capacity, self.size), points.shape[1]))
+        self.points[:self.size] = points
+
+
+    def add(self, point):
+        """ Appends a point, growing the array if it is full """
+
+        if self.size == len(self.points):
+            grown = numpy.empty((2 * len(self.points), self.points.shape[1]))
+            grown[:self.size] = self.points[:self.size]
+            self.points = grown
+        self.points[self.size] = point
+        self.size += 1
+
+
+    def remove(self, point):
+        """ Removes one point equal to the given one, if there is any
+        Returns True if a point was removed. """
+
+        matches = numpy.flatnonzero((self.points[:self.size] == point).all(axis=1))
+        if not len(matches):
+            return False
+        self.size -= 1
+        self.points[matches[0]] = self.points[self.size]
+        return True
+
+
+class Split(object):
+    """ An inner node of a BucketKDTree. Points with point[axis] < value are in
+    the left subtree, all others in the right one """
+
+    def __init__(self, axis, value, left, right):
+        self.axis = axis
+        self.value = value
+        self.left = left
+        self.right = right
+
+
+class BucketKDTree(object):
+    """ A kd-tree whose leaves hold up to bucket_size points each
+    Queries return points as tuples and measure distances like KDNode:
+    squared euclidean distances by default, or any distance function given
+    as dist. """
+
+
+    def __init__(self, point_list=None, dimensions=None, bucket_size=32):
+        """ Creates a tree from a list of points, or an empty tree of the given
+        number of dimensions, like create() """
+
+        points = numpy.array(point_list if point_list is not None else [], dtype=float)
+        if not len(points) and not dimensions:
+            raise ValueError('either point_list or dimensions must be provided')
+        if bucket_size < 1:
+            raise ValueError('bucket_size must be at least 1')
+
+        if len(points):
+            if points.ndim != 2 or (dimensions and points.shape[1] != dimensions):
+                raise ValueError('All Points in the point_list must have the same dimensionality')
+            dimensions = points.shape[1]
+        self.dimensions = dimensions
+        self.bucket_size = bucket_size
+        self._size = len(points)
+        self.root = self._build(points.reshape(-1, dimensions))
+
+
+    def __len__(self):
+        return self._size
+
+
+    def __iter__(self):
+        """ Iterates over the points of the tree as tuples """
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Leaf):
+                for point in node.points[:node.size].tolist():
+                    yield tuple(point)
+            else:
+                stack.extend((node.right, node.left))
+
+
+    def _build(self, points):
+        """ Builds the subtree of the given (n, dimensions) array of points """
+
+        split = self._choose_split(points)
+        if split is None:
+            return Leaf(points, self.bucket_size)
+        axis, value = split
+        goes_left = points[:, axis] < value
+        return Split(axis, value, self._build(points[goes_left]),
+                     self._build(points[~goes_left]))
+
+
+    def _choose_split(self, points):
+        """ Picks the axis of widest spread and its median to split points on,
+        or None if they fit in a leaf or are all the same """
+
+        if len(points) <= self.bucket_size:
+            return None
+        spread = points.max(axis=0) - points.min(axis=0)
+        axis = int(numpy.argmax(spread))
+        if not spread[axis] > 0:
+            return None
+        coords = points[:, axis]
+        value = numpy.partition(coords, len(coords) // 2)[len(coords) // 2]
+        if not (coords < value).any():
+            # the median is the smallest coordinate, split just above it
+            value = coords[coords > value].min()
+        return axis, float(value)
+
+
+    def _check_point(self, point):
+        point = tuple(float(c) for c in point)
+        if len(point) != self.dimensions:
+            raise ValueError('All Points in the point_list must have the same dimensionality')
+        return point
+
+
+    def _find_leaf(self, point):
+        """ Returns the leaf the point belongs in, its parent and grandparent """
+
+        parent = grandparent = None
+        node = self.root
+        while not isinstance(node, Leaf):
+            grandparent, parent = parent, node
+            node = node.left if point[node.axis] < node.value else node.right
+        return node, parent, grandparent
+
+
+    def add(self, point):
+        """ Adds a point, splitting its leaf if that overflows """
+
+        point = self._check_point(point)
+        leaf, parent, _ = self._find_leaf(point)
+        leaf.add(point)
+        self._size += 1
+
+        if leaf.size > self.bucket_size:
+            subtree = self._build(leaf.points[:leaf.size])
+            if isinstance(subtree, Leaf):
+                # too many copies of the same point to split
+                return
+            if parent is None:
+                self.root = subtree
+            elif parent.left is leaf:
+                parent.left = subtree
+            else:
+                parent.right = subtree
+
+
+    def remove(self, point):
+        """ Removes one point equal to the given one from the tree, if there
+        is any. A leaf left empty is removed with its parent split. Returns the
+        tree itself. """
+
+        point = self._check_point(point)
+        leaf, parent, grandparent = self._find_leaf(point)
+        if not leaf.remove(point):
+            return self
+        self._size -= 1
+
+        if leaf.size == 0 and parent is not None:
+            sibling = parent.right if parent.left is leaf else parent.left
+            if grandparent is None:
+                self.root = sibling
+            elif grandparent.left is parent:
+                grandparent.left = sibling
+            else:
+                grandparent.right = sibling
+        return self
+
+
+    def _leaf_dists(self, leaf, point, dist):
+        """ Distances between the points of a leaf and the given point """
+
+        points = leaf.points[:leaf.size]
+        if dist is None:
+            return ((points - point) ** 2).sum(axis=1)
+        return numpy.array([dist(tuple(p), point) for p in points.tolist()], dtype=float)
+
+
+    def search_knn(self, point, k, dist=None):
+        """ Return the k nearest points to point and their distances
+        point must be a location. The result is a list of (point, distance)
+        tuples ordered by distance, with fewer than k entries only if there
+        are fewer points. Points beyond the k-th are not included when their
+        distances are equal.
+        dist is a distance function, expecting two points and returning a
+        distance value. Subtrees are skipped by comparing it with the distance
+        along one axis, so it must not be smaller than that, like any
+        euclidean or Minkowski distance. """
+
+        point = self._check_point(point)
+        axis_dist = (lambda diff: diff * diff) if dist is None else abs
+
+        # max heap of (-distance, -order, point) of the best points so far
+        best = []
+        order = 0
+        stack = [(self.root, 0.)]
+        while stack:
+            node, bound = stack.pop()
+            if len(best) == k and bound > -best[0][0]:
+                continue
+
+            if isinstance(node, Leaf):
+                dists = self._leaf_dists(node, point, dist)
+                worst = -best[0][0] if len(best) == k else numpy.inf
+                for i in numpy.flatnonzero(dists < worst).tolist():
+                    if len(best) == k and not dists[i] < -best[0][0]:
+                        continue
+                    order += 1
+                    entry = (-float(dists[i]), -order, tuple(node.points[i].tolist()))
+                    if len(best) < k:
+                        heapq.heappush(best, entry)
+                    else:
+                        heapq.heapreplace(best, entry)
+                continue
+
+            # visit the side of the splitting plane the point is on first
+            diff = point[node.axis] - node.value
+            near, far = (node.left, node.right) if diff < 0 else (node.right, node.left)
+            stack.append((far, max(bound, axis_dist(diff))))
+            stack.append((near, bound))
+
+        return [(p, -neg_dist) for neg_dist, _, p in sorted(best, reverse=True)]
+
+
+    def search_nn(self, point, dist=None):
+        """ Search the nearest point to the given point
+        The result is a (point, distance) tuple, see search_knn. """
+
+        return next(iter(self.search_knn(point, 1, dist)), None)
+
+
+    def search_nn_dist(self, point, distance):
+        """ Search the points closer than the given (euclidean) distance to
+        point. Returns a list of them, in no particular order. """
+
+        found = []
+        for leaf, inside in self._iter_nn_dist(point, distance):
+            found.extend(tuple(p) for p in leaf.points[:leaf.size][inside].tolist())
+        return found
+
+
+    def count_nn_dist(self, point, distance):
+        """ Count the points closer than distance to point """
+
+        return sum(int(inside.sum()) for _, inside in self._iter_nn_dist(point, distance))
+
+
+    def _iter_nn_dist(self, point, distance):
+        """ Iterates over the leaves near point, each with a mask of its points
+        closer than distance """
+
+        point = self._check_point(point)
+        max_dist = distance * distance
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Leaf):
+                yield node, self._leaf_dists(node, point, None) < max_dist
+                continue
+
+            diff = point[node.axis] - node.value
+            near, far = (node.left, node.right) if diff < 0 else (node.right, node.left)
+            if diff * diff < max_dist:
+                stack.append(far)
+            stack.append(near)
@@ -8,7 +8,7 @@ https://en.wikipedia.org/wiki/K-d_tree
 
 from __future__ import print_function
 
-import operator
+import heapq
 import math
 from collections import deque
 from functools import wraps
@@ -19,12 +19,6 @@ __website__ = 'https://github.com/stefankoegl/kdtree'
 __license__ = 'ISC license'
 
 
-# maps child position to its comparison operator
-COMPARE_CHILD = {
-    0: (operator.le, operator.sub),
-    1: (operator.ge, operator.add),
-}
-
 
 class Node(object):
     """ A Node in a kd-tree
@@ -390,116 +384,57 @@ class KDNode(Node):
         (if there aren't more nodes to return) or more in case of equal
         distances.
         dist is a distance function, expecting two points and returning a
-        distance value. Distance values can be any compareable type.
+        distance value. Distance values can be any numeric type. Subtrees are
+        skipped by comparing the distance along one axis with it, so it must
+        not be smaller than that, like any euclidean or Minkowski distance.
         The result is an ordered list of (node, distance) tuples.
         """
 
-        prev = None
-        current = self
+        if not self:
+            return []
 
         if dist is None:
             get_dist = lambda n: n.dist(point)
+            # the default distance is squared, so the axis distance must be too
+            axis_dist = lambda diff: diff * diff
         else:
             get_dist = lambda n: dist(n.data, point)
-
-        # the nodes do not keep a reference to their parents
-        parents = {current: None}
-
-        # go down the tree as we would for inserting
-        while current:
-            if point[current.axis] < current.data[current.axis]:
-                # left side
-                parents[current.left] = current
-                prev = current
-                current = current.left
-            else:
-                # right side
-                parents[current.right] = current
-                prev = current
-                current = current.right
-
-        if not prev:
-            return []
-
-        examined = set()
-        results = {}
-
-        # Go up the tree, looking for better solutions
-        current = prev
-        while current:
-            # search node and update results
-            current._search_node(point, k, results, examined, get_dist)
-            current = parents[current]
-
-        BY_VALUE = lambda kv: kv[1]
-        return sorted(results.items(), key=BY_VALUE)
-
-
-    def _search_node(self, point, k, results, examined, get_dist):
-        examined.add(self)
-
-        # get current best
-        if not results:
-            bestNode = None
-            bestDist = float('inf')
-
-        else:
-            bestNode, bestDist = sorted(results.items(), key=lambda n_d: n_d[1], reverse=True)[0]
-
-        nodesChanged = False
-
-        # If the current node is closer than the current best, then it
-        # becomes the current best.
-        nodeDist = get_dist(self)
-        if nodeDist < bestDist:
-            if len(results) == k and bestNode:
-               results.pop(bestNode)
-
-            results[self] = nodeDist
-            nodesChanged = True
-
-        # if we're equal to the current best, add it, regardless of k
-        elif nodeDist == bestDist:
-            results[self] = nodeDist
-            nodesChanged = True
-
-        # if we don't have k results yet, add it anyway
-        elif len(results) < k:
-            results[self] = nodeDist
-            nodesChanged = True
-
-        # get new best only if nodes have changed
-        if nodesChanged:
-            bestNode, bestDist = next(iter(
-                sorted(results.items(), key=lambda n: n[1], reverse=True)
-            ))
-
-        # Check whether there could be any points on the other side of the
-        # splitting plane that are closer to the search point than the current
-        # best.
-        for child, pos in self.children:
-            if child in examined:
+            axis_dist = abs
+
+        # max heap of (-distance, -order, node) of the k best nodes so far, and
+        # the nodes that were left out for being as far as the k-th best
+        best = []
+        ties = []
+        order = 0
+
+        # (node, lower bound of the distance to any node in its subtree)
+        stack = [(self, 0)]
+        while stack:
+            node, bound = stack.pop()
+            if len(best) == k and bound > -best[0][0]:
                 continue
 
-            examined.add(child)
-            compare, combine = COMPARE_CHILD[pos]
-
-            # Since the hyperplanes are all axis-aligned this is implemented
-            # as a simple comparison to see whether the difference between the
-            # splitting coordinate of the search point and current node is less
-            # than the distance (overall coordinates) from the search point to
-            # the current best.
-            nodePoint = self.data[self.axis]
-            pointPlusDist = combine(point[self.axis], bestDist)
-            lineIntersects = compare(pointPlusDist, nodePoint)
-
-            # If the hypersphere crosses the plane, there could be nearer
-            # points on the other side of the plane, so the algorithm must move
-            # down the other branch of the tree from the current node looking
-            # for closer points, following the same recursive process as the
-            # entire search.
-            if lineIntersects:
-                child._search_node(point, k, results, examined, get_dist)
+            node_dist = get_dist(node)
+            order += 1
+            if len(best) < k:
+                heapq.heappush(best, (-node_dist, -order, node))
+            elif node_dist < -best[0][0]:
+                ties.append(heapq.heapreplace(best, (-node_dist, -order, node)))
+            elif node_dist == -best[0][0]:
+                ties.append((-node_dist, -order, node))
+
+            # visit the side of the splitting plane the point is on first
+            diff = point[node.axis] - node.data[node.axis]
+            near, far = (node.left, node.right) if diff < 0 else (node.right, node.left)
+            if far:
+                stack.append((far, max(bound, axis_dist(diff))))
+            if near:
+                stack.append((near, bound))
+
+        if best:
+            ties = [tie for tie in ties if tie[0] == best[0][0]]
+        results = sorted(best + ties, key=lambda t: (-t[0], -t[1]))
+        return [(node, -neg_dist) for neg_dist, _, node in results]
 
 
     @require_axis
@@ -520,28 +455,50 @@ class KDNode(Node):
     @require_axis
     def search_nn_dist(self, point, distance, best=None):
         """
-        Search the n nearest nodes of the given point which are within given
-        distance
-        point must be a location, not a node. A list containing the n nearest
-        nodes to the point within the distance will be returned.
+        Search the nodes of the given point which are within given distance
+        point must be a location, not a node. A list containing the nodes
+        closer than distance to the point, in no particular order, will be
+        returned (appended to best, if given).
         """
 
         if best is None:
             best = []
+        best.extend(self._iter_nn_dist(point, distance))
+        return best
 
-        # consider the current node
-        if self.dist(point) < distance:
-            best.append(self)
 
-        # sort the children, nearer one first (is this really necessairy?)
-        children = sorted(self.children, key=lambda c_p1: c_p1[0].dist(point))
+    @require_axis
+    def count_nn_dist(self, point, distance):
+        """
+        Count the nodes which are closer than distance to the given point,
+        without building a list of them
+        """
 
-        for child, p in children:
-            # check if child node needs to be recursed
-            if self.axis_dist(point, self.axis) < math.pow(distance, 2):
-                child.search_nn_dist(point, distance, best)
+        return sum(1 for _ in self._iter_nn_dist(point, distance))
 
-        return best
+
+    def _iter_nn_dist(self, point, distance):
+        """ Iterates over the nodes closer than distance to point """
+
+        if not self:
+            return
+
+        # the node distances are squared, so compare everything squared
+        max_dist = distance * distance
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.dist(point) < max_dist:
+                yield node
+
+            # the subtree across the splitting plane only matters if the ball
+            # around the point crosses the plane
+            diff = point[node.axis] - node.data[node.axis]
+            near, far = (node.left, node.right) if diff < 0 else (node.right, node.left)
+            if far and diff * diff < max_dist:
+                stack.append(far)
+            if near:
+                stack.append(near)
 
 
     @require_axis
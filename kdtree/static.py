@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+
+
+"""A static, array backed kd-tree
+The tree is built once from all of its points and can not be changed
+afterwards. Instead of one KDNode object per point, the nodes are rows of a
+few flat NumPy arrays, and the build selects every median with argpartition,
+one level of the tree at a time, in O(n log n) overall.
+"""
+
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+
+class StaticKDTree(object):
+    """ A kd-tree over a fixed set of points, stored as flat arrays
+    Node i holds the point points[index[i]], splits its subtree on axis[i] at
+    split[i] and has the children left[i] and right[i] (-1 if missing). The
+    root is node 0, the axis cycles with the depth like in create(), and
+    points on the splitting plane can be on either side of it.
+
+    Queries identify points by their position in the list the tree was built
+    from, and measure distances like KDNode: squared euclidean distances by
+    default, or any distance function given as dist. """
+
+
+    def __init__(self, point_list):
+        """ Builds the tree from a list or (n, dimensions) array of points """
+
+        points = numpy.array(point_list, dtype=float)
+        if points.ndim != 2 or not len(points):
+            raise ValueError('point_list must be a non-empty list of points '
+                             'that all have the same dimensionality')
+
+        n, self.dimensions = points.shape
+        int_type = numpy.int32 if n < 2 ** 31 else numpy.int64
+        self.index = numpy.empty(n, dtype=int_type)
+        self.axis = numpy.empty(n, dtype=numpy.uint8 if self.dimensions < 256 else int_type)
+        self.left = numpy.full(n, -1, dtype=int_type)
+        self.right = numpy.full(n, -1, dtype=int_type)
+        # the nodes in order, so that every subtree is a contiguous range
+        self._inorder = numpy.empty(n, dtype=int_type)
+
+        # the points of the subtree of each node of the current level are
+        # perm[start:start + size], with the median going to the node
+        perm = numpy.arange(n, dtype=int_type)
+        starts = numpy.zeros(1, dtype=numpy.int64)
+        sizes = numpy.full(1, n, dtype=numpy.int64)
+        first, depth = 0, 0
+        while len(starts):
+            nodes = first + numpy.arange(len(starts))
+            axis = depth % self.dimensions
+            self.axis[nodes] = axis
+            self._inorder[starts + sizes // 2] = nodes
+
+            # the subtrees of a level differ in size by at most one, so the
+            # medians can be selected in at most two batches
+            for size in numpy.unique(sizes):
+                batch = sizes == size
+                cells = starts[batch, None] + numpy.arange(size)
+                idxs = perm[cells]
+                order = numpy.argpartition(points[idxs, axis], size // 2, axis=1)
+                idxs = numpy.take_along_axis(idxs, order, axis=1)
+                perm[cells] = idxs
+                self.index[nodes[batch]] = idxs[:, size // 2]
+
+            # the subtrees of the children that are not empty, in node order
+            child_starts = numpy.column_stack((starts, starts + sizes // 2 + 1)).ravel()
+            child_sizes = numpy.column_stack((sizes // 2, sizes - sizes // 2 - 1)).ravel()
+            has_child = child_sizes > 0
+            child_nodes = numpy.full(len(child_sizes), -1, dtype=numpy.int64)
+            child_nodes[has_child] = first + len(starts) + numpy.arange(has_child.sum())
+            self.left[nodes] = child_nodes[0::2]
+            self.right[nodes] = child_nodes[1::2]
+
+            first += len(starts)
+            starts, sizes = child_starts[has_child], child_sizes[has_child]
+            depth += 1
+
+        # the coordinates in node order, so that a node's point is contiguous
+        self.data = points[self.index]
+        self.split = self.data[numpy.arange(n), self.axis]
+
+        # memoryviews give fast access to single elements as Python scalars
+        self._data = memoryview(self.data.ravel())
+        self._axis = memoryview(self.axis)
+        self._split = memoryview(self.split)
+        self._left = memoryview(self.left)
+        self._right = memoryview(self.right)
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def _node_dist(self, node, point, dist):
+        """ Distance between the point of a node and the given point """
+
+        d = self.dimensions
+        coords = self._data[node * d:(node + 1) * d]
+        if dist is None:
+            return sum([(c - p) ** 2 for c, p in zip(coords, point)])
+        return dist(tuple(coords), point)
+
+
+    def search_knn(self, point, k, dist=None):
+        """ Return the k nearest points to point and their distances
+        point must be a location. The result is a list of (i, distance)
+        tuples ordered by distance, where i is the position of the point in
+        the point list, with fewer than k entries only if there are fewer
+        points. Unlike KDNode.search_knn, points beyond the k-th are not
+        included when their distances are equal.
+        dist is a distance function, expecting two points and returning a
+        distance value. Subtrees are skipped by comparing it with the distance
+        along one axis, so it must not be smaller than that, like any
+        euclidean or Minkowski distance. """
+
+        point = tuple(float(c) for c in point)
+        if len(point) != self.dimensions:
+            raise ValueError('point must have %d coordinates' % self.dimensions)
+        axis_dist = (lambda diff: diff * diff) if dist is None else abs
+
+        # max heap of (-distance, -node) of the best points found so far
+        best = []
+        stack = [(0, 0.)]
+        while stack:
+            node, bound = stack.pop()
+            if len(best) == k and bound > -best[0][0]:
+                continue
+
+            node_dist = self._node_dist(node, point, dist)
+            if len(best) < k:
+                heapq.heappush(best, (-node_dist, -node))
+            elif node_dist < -best[0][0]:
+                heapq.heapreplace(best, (-node_dist, -node))
+
+            # visit the side of the splitting plane the point is on first
+            diff = point[self._axis[node]] - self._split[node]
+            near, far = (self._left[node], self._right[node]) if diff < 0 else \
+                        (self._right[node], self._left[node])
+            if far != -1:
+                stack.append((far, max(bound, axis_dist(diff))))
+            if near != -1:
+                stack.append((near, bound))
+
+        return [(int(self.index[-node]), -neg_dist) for neg_dist, node in sorted(best, reverse=True)]
+
+
+    def search_nn(self, point, dist=None):
+        """ Search the nearest point to the given point
+        The result is an (i, distance) tuple, see search_knn. """
+
+        return next(iter(self.search_knn(point, 1, dist)), None)
+
+
+    def search_nn_dist(self, point, distance):
+        """ Search the points within the given (euclidean) distance of point
+        Returns the positions in the point list of the points that are closer
+        than distance, in increasing order. """
+
+        return sorted(self.index[list(self._iter_nn_dist(point, distance))].tolist())
+
+
+    def count_nn_dist(self, point, distance):
+        """ Count the points closer than distance to point """
+
+        return sum(1 for _ in self._iter_nn_dist(point, distance))
+
+
+    def _iter_nn_dist(self, point, distance):
+        """ Iterates over the nodes closer than distance to point """
+
+        point = tuple(float(c) for c in point)
+        if len(point) != self.dimensions:
+            raise ValueError('point must have %d coordinates' % self.dimensions)
+        max_dist = distance * distance
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self._node_dist(node, point, None) < max_dist:
+                yield node
+
+            diff = point[self._axis[node]] - self._split[node]
+            near, far = (self._left[node], self._right[node]) if diff < 0 else \
+                        (self._right[node], self._left[node])
+            if far != -1 and diff * diff < max_dist:
+                stack.append(far)
+            if near != -1:
+                stack.append(near)
+
+
+    def query(self, points, k=1, workers=None, chunk_size=1024):
+        """ Search the k nearest points to every one of a batch of points
+        points is a list or (m, dimensions) array of locations. They are split
+        into chunks of chunk_size, each of which walks the tree once with
+        NumPy operations on all of its points together, and the chunks are
+        spread over a pool of workers threads (as many as the pool picks by
+        default, 1 to use the calling thread only).
+        Returns (distances, indices), two (m, k) arrays holding the squared
+        euclidean distances and the positions in the point list of the
+        nearest points, ordered by distance. Rows are padded with inf and -1
+        if there are fewer than k points. """
+
+        points = numpy.asarray(points, dtype=float)
+        if points.ndim != 2 or points.shape[1] != self.dimensions:
+            raise ValueError('points must have %d coordinates each' % self.dimensions)
+        if k < 1:
+            raise ValueError('k must be at least 1')
+
+        chunks = [points[i:i + chunk_size] for i in range(0, len(points), chunk_size)]
+        search = lambda chunk: self._query_chunk(chunk, k)
+        if workers == 1 or len(chunks) <= 1:
+            results = [search(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(workers) as pool:
+                results = list(pool.map(search, chunks))
+
+        if not results:
+            return numpy.empty((0, k)), numpy.empty((0, k), dtype=numpy.int64)
+        distances = numpy.concatenate([d for d, _ in results])
+        nodes = numpy.concatenate([n for _, n in results])
+        indices = numpy.where(nodes < 0, -1, self.index[numpy.maximum(nodes, 0)])
+        return distances, indices
+
+
+    def _query_chunk(self, points, k):
+        """ Search the k nearest nodes to every point of a chunk
+        Every point first descends to a subtree of a few times k nodes and
+        takes the nearest of those as its first candidates, which bound the
+        distances well enough that the walk from the root that follows only
+        visits subtrees near the point. Returns (distances, nodes). """
+
+        m, n = len(points), len(self)
+        rows = numpy.arange(m)
+        leaf_size = max(k, 16)
+
+        # descend to the subtree of at most 2 * leaf_size nodes around each
+        # point, tracking the range of the subtree in the node order
+        nodes = numpy.zeros(m, dtype=numpy.int64)
+        starts = numpy.zeros(m, dtype=numpy.int64)
+        sizes = numpy.full(m, n, dtype=numpy.int64)
+        while True:
+            descend = sizes > 2 * leaf_size
+            if not descend.any():
+                break
+            go_left = points[rows, self.axis[nodes]] < self.split[nodes]
+            half = sizes // 2
+            nodes = numpy.where(descend, numpy.where(go_left, self.left[nodes],
+                                                     self.right[nodes]), nodes)
+            starts = numpy.where(descend & ~go_left, starts + half + 1, starts)
+            sizes = numpy.where(descend, numpy.where(go_left, half, sizes - half - 1), sizes)
+
+        # the nearest nodes of that subtree are the first candidates
+        width = int(sizes.max())
+        cells = starts[:, None] + numpy.arange(width)
+        in_bucket = cells < (starts + sizes)[:, None]
+        cell_nodes = self._inorder[numpy.minimum(cells, n - 1)].astype(numpy.int64)
+        cell_dists = ((self.data[cell_nodes] - points[:, None, :]) ** 2).sum(axis=2)
+        cell_dists[~in_bucket] = numpy.inf
+        cell_nodes[~in_bucket] = -1
+        if width > k:
+            nearest = numpy.argpartition(cell_dists, k - 1, axis=1)[:, :k]
+            cell_dists = numpy.take_along_axis(cell_dists, nearest, axis=1)
+            cell_nodes = numpy.take_along_axis(cell_nodes, nearest, axis=1)
+        elif width < k:
+            cell_dists = numpy.pad(cell_dists, ((0, 0), (0, k - width)),
+                                   constant_values=numpy.inf)
+            cell_nodes = numpy.pad(cell_nodes, ((0, 0), (0, k - width)), constant_values=-1)
+        order = numpy.argsort(cell_dists, axis=1, kind='stable')
+        best_dists = numpy.take_along_axis(cell_dists, order, axis=1)
+        best_nodes = numpy.take_along_axis(cell_nodes, order, axis=1)
+        bucket_starts, bucket_ends = starts, starts + sizes
+
+        # walk the tree one level at a time, as (point, node, subtree start,
+        # subtree size, lower bound of the distance to the subtree) tuples
+        pairs = (rows, numpy.zeros(m, dtype=numpy.int64), numpy.zeros(m, dtype=numpy.int64),
+                 numpy.full(m, n, dtype=numpy.int64), numpy.zeros(m))
+        while len(pairs[0]):
+            q, node, start, size, bound = pairs
+            worst = best_dists[q, -1]
+            # skip subtrees too far away, and those already searched
+            keep = (bound < worst) & ~((start >= bucket_starts[q]) &
+                                       (start + size <= bucket_ends[q]))
+            q, node, start, size, bound, worst = \
+                q[keep], node[keep], start[keep], size[keep], bound[keep], worst[keep]
+
+            pos = start + size // 2
+            node_dists = ((self.data[node] - points[q]) ** 2).sum(axis=1)
+            better = (node_dists < worst) & ((pos < bucket_starts[q]) | (pos >= bucket_ends[q]))
+            if better.any():
+                self._merge_best(best_dists, best_nodes, q[better], node_dists[better],
+                                 node[better])
+
+            diff = points[q, self.axis[node]] - self.split[node]
+            far_bound = numpy.maximum(bound, diff * diff)
+            half = size // 2
+            children = (numpy.concatenate((self.left[node], self.right[node])).astype(numpy.int64),
+                        numpy.concatenate((start, start + half + 1)),
+                        numpy.concatenate((half, size - half - 1)),
+                        numpy.concatenate((numpy.where(diff < 0, bound, far_bound),
+                                           numpy.where(diff < 0, far_bound, bound))))
+            q = numpy.concatenate((q, q))
+            exists = children[0] >= 0
+            pairs = (q[exists],) + tuple(c[exists] for c in children)
+
+        return best_dists, best_nodes
+
+
+    def query_radius(self, points, distance, count_only=False, workers=None,
+                     chunk_size=1024):
+        """ Search the points within distance of every one of a batch of points
+        points is a list or (m, dimensions) array of locations, and distance
+        is either one distance for all of them or an array of m distances. The
+        chunks are walked and spread over workers like in query().
+        With count_only, returns an array of the m numbers of points closer
+        than the distance. Otherwise returns (indptr, indices) in compressed
+        sparse row form: the positions in the point list of the points closer
+        than distance to point i are indices[indptr[i]:indptr[i + 1]], in
+        increasing order. """
+
+        points = numpy.asarray(points, dtype=float)
+        if points.ndim != 2 or points.shape[1] != self.dimensions:
+            raise ValueError('points must have %d coordinates each' % self.dimensions)
+        max_dists = numpy.broadcast_to(numpy.asarray(distance, dtype=float) ** 2,
+                                       (len(points),))
+
+        bounds = range(0, len(points), chunk_size)
+        search = lambda i: self._query_radius_chunk(points[i:i + chunk_size],
+                                                    max_dists[i:i + chunk_size], count_only)
+        if workers == 1 or len(bounds) <= 1:
+            results = [search(i) for i in bounds]
+        else:
+            with ThreadPoolExecutor(workers) as pool:
+                results = list(pool.map(search, bounds))
+
+        counts = numpy.concatenate([c for c, _ in results] or [numpy.zeros(0, numpy.int64)])
+        if count_only:
+            return counts
+        indptr = numpy.concatenate(([0], numpy.cumsum(counts)))
+        indices = numpy.concatenate([i for _, i in results] or [numpy.zeros(0, numpy.int64)])
+        return indptr, indices
+
+
+    def _query_radius_chunk(self, points, max_dists, count_only):
+        """ Search the nodes closer than the square root of max_dists to every
+        point of a chunk, walking the tree one level at a time like
+        _query_chunk. Returns (counts, indices), the latter in CSR order or
+        None with count_only. """
+
+        m = len(points)
+        counts = numpy.zeros(m, dtype=numpy.int64)
+        found_q, found_nodes = [], []
+
+        # (point, node, lower bound of the squared distance to the subtree)
+        q = numpy.arange(m)
+        node = numpy.zeros(m, dtype=numpy.int64)
+        bound = numpy.zeros(m)
+        while len(q):
+            keep = bound < max_dists[q]
+            q, node, bound = q[keep], node[keep], bound[keep]
+
+            inside = ((self.data[node] - points[q]) ** 2).sum(axis=1) < max_dists[q]
+            counts += numpy.bincount(q[inside], minlength=m)
+            if not count_only:
+                found_q.append(q[inside])
+                found_nodes.append(node[inside])
+
+            diff = points[q, self.axis[node]] - self.split[node]
+            far_bound = numpy.maximum(bound, diff * diff)
+            children = numpy.concatenate((self.left[node], self.right[node])).astype(numpy.int64)
+            bounds = numpy.concatenate((numpy.where(diff < 0, bound, far_bound),
+                                        numpy.where(diff < 0, far_bound, bound)))
+            exists = children >= 0
+            q, node, bound = numpy.concatenate((q, q))[exists], children[exists], bounds[exists]
+
+        if count_only:
+            return counts, None
+        found_q = numpy.concatenate(found_q or [numpy.zeros(0, numpy.int64)])
+        found = self.index[numpy.concatenate(found_nodes or [numpy.zeros(0, numpy.int64)])]
+        return counts, found[numpy.lexsort((found, found_q))].astype(numpy.int64)
+
+
+    @staticmethod
+    def _merge_best(best_dists, best_nodes, q, dists, nodes):
+        """ Merges candidates for the points q into the sorted (m, k) best
+        distances and nodes, in place """
+
+        k = best_dists.shape[1]
+        rows, q = numpy.unique(q, return_inverse=True)
+        all_q = numpy.concatenate((numpy.repeat(numpy.arange(len(rows)), k), q))
+        all_dists = numpy.concatenate((best_dists[rows].ravel(), dists))
+        all_nodes = numpy.concatenate((best_nodes[rows].ravel(), nodes))
+        order = numpy.lexsort((all_dists, all_q))
+        all_q, all_dists, all_nodes = all_q[order], all_dists[order], all_nodes[order]
+        keep = numpy.arange(len(all_q)) - numpy.searchsorted(all_q, all_q) < k
+        best_dists[rows] = all_dists[keep].reshape(len(rows), k)
+        best_nodes[rows] = all_nodes[keep].reshape(len(rows), k)
@@ -2,12 +2,19 @@
 File: streaminginterpolators.py
 Author: Evan Smith
 Date Created: 10/22/15
-Date Last Modified: 10/23/15
-Python Version: 2.7.10
+Date Last Modified: 10/16/26
+Python Version: 3.8+
 Description: Classes to efficiently interpolate streamed data
 """
 from abc import ABCMeta, abstractmethod
+from bisect import bisect_left
 from bintrees import AVLTree
+import kdtree
+import math
+import numpy
+import os
+import threading
+import weakref
 
 
 class StreamingInterpolatorBase(object):
@@ -24,12 +31,473 @@ class StreamingInterpolatorBase(object):
         ''' Get the interpolated value for the given x '''
         return
 
+    def insertBatch(self, xs, vals):
+        '''
+        Register a batch of datapoints, as if they were inserted one by one
+
+        xs (sequence of floats) : the x coordinates of the datapoints
+        vals (sequence of floats) : the rest of the datapoints
+        '''
+        for x, val in zip(xs, vals):
+            self.insert(x, val)
+
+    def _isExpired(self, x):
+        '''
+        Check whether x falls before the window of a bounded history, see
+        SortedArrayHistory.isExpired
+
+        x (float or numpy.ndarray) : the x coordinate(s)
+        returns (bool or numpy.ndarray) : true where no value should be given
+        '''
+        isExpired = getattr(self._history, 'isExpired', None)
+        return isExpired is not None and isExpired(x)
+
+
+class SortedArrayHistory(object):
+    '''
+    Datapoints kept in sorted, growable arrays, which can be used as the history
+    of a streaming interpolator in place of an AVLTree. Datapoints that arrive in
+    increasing x order are appended in amortized O(1). A datapoint that arrives
+    out of order is inserted in place, shifting only the datapoints after it.
+
+    The history can also be bounded to the maxCount datapoints with the largest
+    x, and/or to the datapoints within maxSpan of the largest x. The oldest
+    datapoints are then evicted from the front of the arrays in O(1) each, and
+    the arrays slide back to the front of their buffer once half of it is free.
+    expiredPolicy decides what interpolators return for an x before the
+    datapoints retained by the window once anything has been evicted:
+    'clamp' treats it like any other x before the first datapoint, 'none'
+    gives None (nan in batch queries) and 'raise' raises a ValueError
+
+    With nChannels, every datapoint has a row of nChannels vals, which share
+    the one array of x coordinates, see MultiChannelLinearStreamingInterpolator
+    '''
+
+    EXPIRED_POLICIES = ('clamp', 'none', 'raise')
+
+    # a history file starts with _HEADER_WORDS little endian uint64 words: the
+    # magic bytes, the format version, the number of datapoints, nChannels (0
+    # for none), maxCount (0 for none), maxSpan as float64 bits (nan for none),
+    # the index of the expiredPolicy and whether anything has been evicted.
+    # They are followed by the x column and then the vals, a row per
+    # datapoint, all as little endian float64s
+    _FILE_MAGIC = b'SRTDHIST'
+    _FILE_VERSION = 1
+    _HEADER_WORDS = 8
+
+    def __init__(self, maxCount=None, maxSpan=None, expiredPolicy='clamp', nChannels=None):
+        if maxCount is not None and maxCount < 1:
+            raise ValueError('maxCount must be at least 1')
+        if expiredPolicy not in self.EXPIRED_POLICIES:
+            raise ValueError('expiredPolicy must be one of %s' % (self.EXPIRED_POLICIES,))
+        self._xs = numpy.empty(16)
+        self._vals = numpy.empty((16,) if nChannels is None else (16, nChannels))
+        # the datapoints are _xs[_start:_end]
+        self._start = 0
+        self._end = 0
+        # largest x, kept as a float so that in order inserts skip numpy indexing
+        self._maxX = None
+        self._maxCount = maxCount
+        self._maxSpan = maxSpan
+        self._expiredPolicy = expiredPolicy
+        self._hasEvicted = False
+        # path of a history mapped read only by load()
+        self._path = None
+
+    def __len__(self):
+        return self._end - self._start
+
+    def save(self, path):
+        '''
+        Writes the datapoints and the window settings to a file holding a small
+        header followed by the sorted x coordinates and the vals as float64
+        columns, which load() can map back. The file is written next to path and
+        then moved over it, so histories mapped from the old file, this one
+        included, keep working
+
+        path (str) : file path
+        '''
+        header = numpy.zeros(self._HEADER_WORDS, dtype='<u8')
+        header[:5] = (numpy.frombuffer(self._FILE_MAGIC, dtype='<u8')[0],
+                      self._FILE_VERSION, len(self), self.getNumChannels() or 0,
+                      self._maxCount or 0)
+        header[5:6] = numpy.array([numpy.nan if self._maxSpan is None else self._maxSpan],
+                                  dtype='<f8').view('<u8')
+        header[6:] = (self.EXPIRED_POLICIES.index(self._expiredPolicy), self._hasEvicted)
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmpPath, 'wb') as f:
+                header.tofile(f)
+                self.keys().astype('<f8').tofile(f)
+                self.values().astype('<f8').tofile(f)
+            os.replace(tmpPath, path)
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Opens a history file written by save(). With mmap the file is mapped
+        rather than read, which takes the same short time for any number of
+        datapoints, and the history is read only. Otherwise the datapoints are
+        read into memory and more can be inserted
+
+        path (str) : file path
+        mmap (bool) : whether to map the file read only
+        returns (SortedArrayHistory) : history object
+        '''
+        header = numpy.fromfile(path, dtype='<u8', count=cls._HEADER_WORDS)
+        if len(header) != cls._HEADER_WORDS or \
+                header[0] != numpy.frombuffer(cls._FILE_MAGIC, dtype='<u8')[0] or \
+                header[1] != cls._FILE_VERSION:
+            raise ValueError('%s is not a sorted array history file' % path)
+        size, nChannels, maxCount = int(header[2]), int(header[3]), int(header[4])
+        maxSpan = float(header[5:6].view('<f8')[0])
+        history = cls(maxCount or None, None if numpy.isnan(maxSpan) else maxSpan,
+                      cls.EXPIRED_POLICIES[int(header[6])], nChannels or None)
+        history._hasEvicted = bool(header[7])
+
+        valsShape = (size, nChannels) if nChannels else (size,)
+        offset = 8 * cls._HEADER_WORDS
+        if mmap:
+            history._path = path
+            if size:
+                history._xs = numpy.memmap(path, dtype='<f8', mode='r', offset=offset,
+                                           shape=(size,))
+                history._vals = numpy.memmap(path, dtype='<f8', mode='r',
+                                             offset=offset + 8 * size, shape=valsShape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                xs = numpy.fromfile(f, dtype='<f8', count=size)
+                vals = numpy.fromfile(f, dtype='<f8', count=xs.size * (nChannels or 1))
+            if len(vals) != len(xs) * (nChannels or 1):
+                raise ValueError('%s is truncated' % path)
+            history._makeRoom(size)
+            history._xs[:size], history._vals[:size] = xs, vals.reshape(valsShape)
+        history._end = size
+        if size:
+            history._maxX = float(history._xs[size - 1])
+        return history
+
+    def _checkWritable(self):
+        ''' Makes sure the history is not mapped read only from a file '''
+        if self._path is not None:
+            raise ValueError('History file %s is mapped read only' % self._path)
+
+    def insert(self, x, val):
+        '''
+        Register a datapoint, replacing the val of an existing datapoint with the same x
+
+        x (float) : the x coordinate of the datapoint
+        val (float or sequence of nChannels floats): the rest of the datapoint
+        '''
+        self._checkWritable()
+        x = float(x)
+        if self._maxX is None or x > self._maxX:
+            # fast path for datapoints arriving in order
+            if self._end == len(self._xs):
+                self._makeRoom()
+            self._xs[self._end] = x
+            self._vals[self._end] = val
+            self._end += 1
+            self._maxX = x
+            self._evict()
+            return
+
+        start, end = self._start, self._end
+        if self._maxSpan is not None and x < self._maxX - self._maxSpan:
+            # already outside of the window
+            return
+        i = start + numpy.searchsorted(self._xs[start:end], x)
+        if self._xs[i] != x:
+            if self._maxCount is not None and i == start and end - start == self._maxCount:
+                # would be evicted straight away
+                return
+            if end == len(self._xs):
+                self._makeRoom()
+                i += self._start - start
+                start, end = self._start, self._end
+            self._xs[i + 1:end + 1] = self._xs[i:end]
+            self._vals[i + 1:end + 1] = self._vals[i:end]
+            self._xs[i] = x
+            self._end += 1
+        self._vals[i] = val
+        self._evict()
+
+    def insertBatch(self, xs, vals):
+        '''
+        Register a batch of datapoints, as if they were inserted one by one in
+        increasing x order (the last val given for an x wins). A batch past the
+        largest x is appended in one go, anything else is merged with the
+        datapoints in linear time
+
+        xs (sequence of floats) : the x coordinates of the datapoints
+        vals (sequence of floats, or of rows of nChannels floats) : the rest of
+            the datapoints
+        '''
+        self._checkWritable()
+        xs = numpy.asarray(xs, dtype=float)
+        if not len(xs):
+            return
+        vals = numpy.asarray(vals, dtype=float)
+
+        # sort the batch, keeping the last val given for each x
+        order = numpy.argsort(xs, kind='mergesort')
+        xs, vals = xs[order], vals[order]
+        isLast = numpy.append(xs[1:] != xs[:-1], True)
+        xs, vals = xs[isLast], vals[isLast]
+
+        if self._maxX is None or xs[0] > self._maxX:
+            if self._end + len(xs) > len(self._xs):
+                self._makeRoom(len(xs))
+            self._xs[self._end:self._end + len(xs)] = xs
+            self._vals[self._end:self._end + len(xs)] = vals
+            self._end += len(xs)
+            self._maxX = float(xs[-1])
+        else:
+            # drop what insert would drop for being outside of the window already
+            keep = numpy.ones(len(xs), dtype=bool)
+            if self._maxSpan is not None:
+                keep &= xs >= self._maxX - self._maxSpan
+            if self._maxCount is not None and self._end - self._start == self._maxCount:
+                keep &= xs >= self._xs[self._start]
+            xs, vals = xs[keep], vals[keep]
+            if not len(xs):
+                return
+
+            self._merge(xs, vals)
+        self._evict()
+
+    def _merge(self, xs, vals):
+        '''
+        Merges datapoints into the arrays in O(n + m), replacing the vals of
+        existing datapoints with the same x
+
+        xs (numpy.ndarray) : sorted, unique x coordinates
+        vals (numpy.ndarray) : the rest of the datapoints
+        '''
+        start, end = self._start, self._end
+        idxs = numpy.searchsorted(self._xs[start:end], xs)
+        exists = idxs < end - start
+        exists[exists] = self._xs[start + idxs[exists]] == xs[exists]
+        self._vals[start + idxs[exists]] = vals[exists]
+        xs, vals = xs[~exists], vals[~exists]
+        if not len(xs):
+            return
+
+        capacity = len(self._xs)
+        while end - start + len(xs) > capacity:
+            capacity *= 2
+        self._xs, self._vals, size = _mergeSorted(self._xs[start:end], self._vals[start:end],
+                                                  xs, vals, capacity)
+        self._start, self._end = 0, size
+        self._maxX = max(self._maxX, float(xs[-1]))
+
+    def _evict(self):
+        ''' Evicts the oldest datapoints that fall outside of the window '''
+        if self._maxCount is not None and self._end - self._start > self._maxCount:
+            self._start = self._end - self._maxCount
+            self._hasEvicted = True
+        if self._maxSpan is not None:
+            while self._xs[self._start] < self._maxX - self._maxSpan:
+                self._start += 1
+                self._hasEvicted = True
+
+    def _makeRoom(self, count=1):
+        '''
+        Makes room for count datapoints after the last datapoint, by sliding the
+        datapoints to the front of the arrays if at least half of them is free,
+        or else by doubling the capacity of the arrays
+
+        count (int) : number of datapoints to make room for
+        '''
+        size = self._end - self._start
+        capacity = len(self._xs)
+        while 2 * size > capacity or size + count > capacity:
+            capacity *= 2
+        for name in ('_xs', '_vals'):
+            arr = getattr(self, name)
+            moved = arr if capacity == len(arr) else numpy.empty((capacity,) + arr.shape[1:])
+            moved[:size] = arr[self._start:self._end]
+            setattr(self, name, moved)
+        self._start, self._end = 0, size
+
+    def isExpired(self, x):
+        '''
+        Check whether x falls before the datapoints retained by the window after
+        some have been evicted, applying the expiredPolicy
+
+        x (float or numpy.ndarray) : the x coordinate(s)
+        returns (bool or numpy.ndarray) : true where an interpolator should give no value
+        '''
+        if not self._hasEvicted or self._expiredPolicy == 'clamp':
+            return numpy.zeros(numpy.shape(x), dtype=bool)[()]
+        expired = numpy.asarray(x) < self._xs[self._start]
+        if self._expiredPolicy == 'raise' and expired.any():
+            raise ValueError('x is before the retained window, which starts at %r'
+                             % float(self._xs[self._start]))
+        return expired[()]
+
+    def getNumChannels(self):
+        ''' returns (int or None) : number of vals per datapoint, None if just one '''
+        return self._vals.shape[1] if self._vals.ndim == 2 else None
+
+    def is_empty(self):
+        ''' returns (bool) : true if there are no datapoints '''
+        return self._end == self._start
+
+    def min_key(self):
+        ''' returns (float) : the smallest x '''
+        if self.is_empty():
+            raise ValueError('History is empty')
+        return float(self._xs[self._start])
+
+    def max_key(self):
+        ''' returns (float) : the largest x '''
+        if self.is_empty():
+            raise ValueError('History is empty')
+        return self._maxX
+
+    def floor_item(self, x):
+        '''
+        Get the datapoint with the largest x that is not larger than the given x
+
+        x (float) : the x coordinate
+        returns (float, float or numpy.ndarray) : the datapoint
+        '''
+        i = self._start + numpy.searchsorted(self._xs[self._start:self._end], x, 'right') - 1
+        if i < self._start:
+            raise KeyError(str(x))
+        return float(self._xs[i]), self._getVal(i)
+
+    def ceiling_item(self, x):
+        '''
+        Get the datapoint with the smallest x that is not smaller than the given x
+
+        x (float) : the x coordinate
+        returns (float, float or numpy.ndarray) : the datapoint
+        '''
+        i = self._start + numpy.searchsorted(self._xs[self._start:self._end], x)
+        if i == self._end:
+            raise KeyError(str(x))
+        return float(self._xs[i]), self._getVal(i)
+
+    def _getVal(self, i):
+        ''' returns (float or numpy.ndarray) : the val(s) of the datapoint at index i '''
+        return float(self._vals[i]) if self._vals.ndim == 1 else self._vals[i].copy()
+
+    def keys(self):
+        ''' returns (numpy.ndarray) : read only view of the sorted x coordinates '''
+        return self._getReadOnly(self._xs)
+
+    def values(self):
+        '''
+        returns (numpy.ndarray) : read only view of the vals, in x order, with a
+            column per channel if there are nChannels
+        '''
+        return self._getReadOnly(self._vals)
+
+    def _getReadOnly(self, arr):
+        view = arr[self._start:self._end]
+        view.flags.writeable = False
+        return view
+
+
+def _mergeSorted(keys, vals, newKeys, newVals, capacity):
+    '''
+    Merges datapoints into sorted datapoints in O(n + m), writing the result
+    into new arrays so that the old ones stay intact. The new vals replace
+    those of existing datapoints with the same x
+
+    keys (numpy.ndarray) : sorted, unique x coordinates of the datapoints
+    vals (numpy.ndarray) : vals of the datapoints, or a row of vals per
+        datapoint for many channels
+    newKeys (numpy.ndarray) : sorted, unique x coordinates to merge in
+    newVals (numpy.ndarray) : vals to merge in
+    capacity (int) : smallest length of the new arrays
+    returns (numpy.ndarray, numpy.ndarray, int) : the new x coordinate and val
+        arrays, and the number of datapoints at their start
+    '''
+    idxs = numpy.searchsorted(keys, newKeys)
+    isNew = idxs == len(keys)
+    isNew[~isNew] = keys[idxs[~isNew]] != newKeys[~isNew]
+    size = len(keys) + int(isNew.sum())
+
+    # every datapoint moves right by the number of new ones before it
+    newIdxs = idxs + numpy.cumsum(isNew) - isNew
+    isOld = numpy.ones(size, dtype=bool)
+    isOld[newIdxs[isNew]] = False
+    mergedKeys = numpy.empty(max(capacity, size))
+    mergedVals = numpy.empty((len(mergedKeys),) + vals.shape[1:])
+    mergedKeys[:size][isOld] = keys
+    mergedVals[:size][isOld] = vals
+    mergedKeys[newIdxs] = newKeys
+    mergedVals[newIdxs] = newVals
+    return mergedKeys, mergedVals, size
+
+
+def _interpolateSorted(keys, vals, xs):
+    '''
+    Linearly interpolate one x coordinate or a batch of them between sorted
+    datapoints, giving the same values as
+    LinearStreamingInterpolator.getInterpolatedVal
+
+    keys (numpy.ndarray) : sorted x coordinates of the datapoints, at least one
+    vals (numpy.ndarray) : vals of the datapoints, or a row of vals per
+        datapoint for many channels
+    xs (float or numpy.ndarray) : the x coordinate(s) to interpolate at
+    returns (float or numpy.ndarray) : interpolated value(s), a row per x for
+        many channels
+    '''
+    idxs = numpy.searchsorted(keys, xs)
+    if numpy.ndim(xs) == 0:
+        # exact hits and the edges get the val of a datapoint
+        if idxs == len(keys):
+            return vals[-1]
+        if keys[idxs] == xs or idxs == 0:
+            return vals[idxs]
+        return LinearStreamingInterpolator._interpolate(
+            xs, keys[idxs - 1], vals[idxs - 1], keys[idxs], vals[idxs])
+
+    if len(keys) == 1:
+        return vals[numpy.zeros(xs.shape, dtype=int)]
+
+    # interpolate within the closest enclosing interval, then patch in exact
+    # hits and the edges
+    leftIdxs = numpy.clip(idxs - 1, 0, len(keys) - 2)
+    leftXs, rightXs = keys[leftIdxs], keys[leftIdxs + 1]
+    if vals.ndim == 2:
+        xs, leftXs, rightXs = xs[..., None], leftXs[..., None], rightXs[..., None]
+    values = LinearStreamingInterpolator._interpolate(
+        xs, leftXs, vals[leftIdxs], rightXs, vals[leftIdxs + 1])
+    if vals.ndim == 2:
+        xs = xs[..., 0]
+    idxs = numpy.minimum(idxs, len(keys) - 1)
+    exact = keys[idxs] == xs
+    values[exact] = vals[idxs[exact]]
+    values[xs < keys[0]] = vals[0]
+    values[xs > keys[-1]] = vals[-1]
+    return values
+
 
 class LinearStreamingInterpolator(StreamingInterpolatorBase):
     ''' Linear streaming interpolator '''
 
-    def __init__(self):
-        self._history = AVLTree()
+    def __init__(self, history=None):
+        '''
+        history (AVLTree or SortedArrayHistory) : storage for the datapoints, an
+            empty AVLTree by default. SortedArrayHistory is much faster when the
+            datapoints mostly arrive in increasing x order
+        '''
+        self._history = history if history is not None else AVLTree()
+        # (xs, vals) arrays copied from the history for batch queries, or None
+        # if the history has changed since they were copied
+        self._sortedArrays = None
+        # counts the inserts, so that cursors can tell when they are stale
+        self._version = 0
 
     def insert(self, x, val):
         '''
@@ -39,6 +507,22 @@ class LinearStreamingInterpolator(StreamingInterpolatorBase):
         val (float): the rest of the datapoint
         '''
         self._history.insert(x, val)
+        self._sortedArrays = None
+        self._version += 1
+
+    def insertBatch(self, xs, vals):
+        '''
+        Register a batch of datapoints, as if they were inserted one by one
+
+        xs (sequence of floats) : the x coordinates of the datapoints
+        vals (sequence of floats) : the rest of the datapoints
+        '''
+        if isinstance(self._history, SortedArrayHistory):
+            self._history.insertBatch(xs, vals)
+        else:
+            self._history.update(zip(xs, vals))
+        self._sortedArrays = None
+        self._version += 1
 
     def getInterpolatedVal(self, x):
         '''
@@ -47,7 +531,7 @@ class LinearStreamingInterpolator(StreamingInterpolatorBase):
         x (float) : the x coordinate of the datapoint
         returns (float) : interpolated value
         '''
-        if self._history.is_empty():
+        if self._history.is_empty() or self._isExpired(x):
             return None
 
         leftX, leftVal = None, None
@@ -67,21 +551,507 @@ class LinearStreamingInterpolator(StreamingInterpolatorBase):
         elif rightVal == None:
             return leftVal
 
+        return self._interpolate(x, leftX, leftVal, rightX, rightVal)
+
+    @staticmethod
+    def _interpolate(x, leftX, leftVal, rightX, rightVal):
+        '''
+        Interpolate strictly between two datapoints
+
+        x (float) : the x coordinate, with leftX < x < rightX
+        leftX, leftVal (float, float) : the closest datapoint to the left
+        rightX, rightVal (float, float) : the closest datapoint to the right
+        returns (float) : interpolated value. Any of the arguments can also be
+            numpy arrays, which are broadcast and give an array
+        '''
         # find weighted average of the vals of the closest enclosing data
         # points
         intervalLength = abs(x - leftX) + abs(x - rightX)
-        value = float(abs(x - rightX) * leftVal + abs(x - leftX)
-                      * rightVal) / intervalLength
-        return value
+        value = (abs(x - rightX) * leftVal + abs(x - leftX) * rightVal) / intervalLength
+        return value if isinstance(value, numpy.ndarray) else float(value)
 
+    def save(self, path):
+        '''
+        Writes the datapoints to a file, see SortedArrayHistory.save. An AVLTree
+        history is written in the same format
 
-# FIXME: yea, so this is useless if restricted to 1 dimension
-class NearestNeighborStreamingInterpolator(StreamingInterpolatorBase):
-    ''' Nearest Neighbor 1D Streaming Interpolator '''
+        path (str) : file path
+        '''
+        history = self._history
+        if not isinstance(history, SortedArrayHistory):
+            history = SortedArrayHistory()
+            if not self._history.is_empty():
+                history.insertBatch(*self._getSortedArrays())
+        history.save(path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Opens a file written by save() as an interpolator with a
+        SortedArrayHistory, see SortedArrayHistory.load
+
+        path (str) : file path
+        mmap (bool) : whether to map the file read only, rather than read it
+        returns (LinearStreamingInterpolator) : interpolator object
+        '''
+        return cls(SortedArrayHistory.load(path, mmap))
+
+    def getCursor(self):
+        '''
+        returns (LinearInterpolationCursor) : a cursor for queries that move
+            through x a little at a time
+        '''
+        return LinearInterpolationCursor(self)
+
+    def getInterpolatedVals(self, xs):
+        '''
+        Get the interpolated values for a whole batch of x coordinates in one
+        pass. Each value is the same as getInterpolatedVal would return for it
+
+        xs (list of floats or numpy.ndarray) : the x coordinates of the datapoints
+        returns (numpy.ndarray) : interpolated values, nan where a bounded
+            history's expiredPolicy gives no value
+        '''
+        if self._history.is_empty():
+            return None
+
+        keys, vals = self._getSortedArrays()
+        xs = numpy.asarray(xs, dtype=float)
+        values = _interpolateSorted(keys, vals, xs)
+        return numpy.where(self._isExpired(xs), numpy.nan, values)
+
+    def _getSortedArrays(self):
+        '''
+        Get the datapoints as sorted arrays, copying them out of the history
+        only if it has changed since the last call
+
+        returns (numpy.ndarray, numpy.ndarray) : x coordinates and vals
+        '''
+        if isinstance(self._history, SortedArrayHistory):
+            return self._history.keys(), self._history.values()
+        if self._sortedArrays is None:
+            self._sortedArrays = (
+                numpy.fromiter(self._history.keys(), dtype=float, count=len(self._history)),
+                numpy.fromiter(self._history.values(), dtype=float, count=len(self._history)))
+        return self._sortedArrays
+
+
+class LinearInterpolationCursor(object):
+    '''
+    Cursor over a LinearStreamingInterpolator that remembers where its last
+    query landed. The next query gallops out from there, so one at a nearby x
+    takes O(1) and one that jumps k datapoints away takes O(log(k)). Sweeping
+    m increasing x coordinates across n datapoints costs O(m + n) rather than
+    O(m log(n)). Gives the same values as the interpolator's getInterpolatedVal.
+
+    The datapoints are copied out of the interpolator into lists, again after
+    every insert into it, so a cursor is meant for sweeps between inserts
+    '''
+
+    def __init__(self, interpolator):
+        '''
+        interpolator (LinearStreamingInterpolator) : the interpolator to query
+        '''
+        self._interpolator = interpolator
+        self._version = None
+        self._keys = []
+        self._vals = []
+        # index of the first datapoint with an x not smaller than the last query
+        self._i = 0
+
+    def getInterpolatedVal(self, x):
+        '''
+        Get the interpolated value for the given x
+
+        x (float) : the x coordinate of the datapoint
+        returns (float) : interpolated value
+        '''
+        if self._version != self._interpolator._version:
+            self._refresh()
+        keys, vals = self._keys, self._vals
+        if not keys or self._interpolator._isExpired(x):
+            return None
+
+        i = self._i = self._seek(x)
+        if i == len(keys):
+            return vals[-1]
+        if keys[i] == x or i == 0:
+            return vals[i]
+        return self._interpolator._interpolate(x, keys[i - 1], vals[i - 1], keys[i], vals[i])
+
+    def iterInterpolatedVals(self, xs):
+        '''
+        Iterate over the interpolated values of a sequence of x coordinates
+
+        xs (iterable of floats) : the x coordinates, ideally close to sorted
+        returns (generator of floats) : interpolated values
+        '''
+        for x in xs:
+            yield self.getInterpolatedVal(x)
+
+    def _refresh(self):
+        ''' Copy the datapoints out of the interpolator '''
+        self._version = self._interpolator._version
+        if self._interpolator._history.is_empty():
+            self._keys, self._vals = [], []
+        else:
+            keys, vals = self._interpolator._getSortedArrays()
+            self._keys, self._vals = keys.tolist(), vals.tolist()
+        self._i = min(self._i, len(self._keys))
+
+    def _seek(self, x):
+        '''
+        Find the index of the first datapoint with an x not smaller than x,
+        galloping out from the last one found
+
+        x (float) : the x coordinate
+        returns (int) : the index, len(keys) if every x is smaller
+        '''
+        keys, i, n = self._keys, self._i, len(self._keys)
+        if i < n and keys[i] < x:
+            # gallop right
+            lo, step = i + 1, 1
+            while lo + step < n and keys[lo + step] < x:
+                lo += step
+                step *= 2
+            return bisect_left(keys, x, lo, min(lo + step, n))
+        if i > 0 and keys[i - 1] >= x:
+            # gallop left
+            hi, step = i - 1, 1
+            while hi - step >= 0 and keys[hi - step] >= x:
+                hi -= step
+                step *= 2
+            return bisect_left(keys, x, max(hi - step, 0), hi)
+        return i
+
+
+class MultiChannelLinearStreamingInterpolator(StreamingInterpolatorBase):
+    '''
+    Linear streaming interpolator for many channels sampled at the same x
+    coordinates. The datapoints are kept in one SortedArrayHistory with a row
+    of vals per x, so every x is stored once rather than once per channel, and
+    a single bracket lookup interpolates all of the channels, or a subset of
+    them, at once
+    '''
+
+    def __init__(self, nChannels, history=None):
+        '''
+        nChannels (int) : number of vals per datapoint
+        history (SortedArrayHistory) : storage for the datapoints, with the same
+            nChannels. An empty unbounded one by default
+        '''
+        if history is None:
+            history = SortedArrayHistory(nChannels=nChannels)
+        elif history.getNumChannels() != nChannels:
+            raise ValueError('history must have %d channels' % nChannels)
+        self._history = history
+
+    def getNumChannels(self):
+        ''' returns (int) : number of vals per datapoint '''
+        return self._history.getNumChannels()
+
+    def insert(self, x, vals):
+        '''
+        Register a datapoint
+
+        x (float) : the x coordinate of the datapoint
+        vals (sequence of floats) : the val of every channel
+        '''
+        self._history.insert(x, vals)
+
+    def insertBatch(self, xs, vals):
+        '''
+        Register a batch of datapoints, as if they were inserted one by one
+
+        xs (sequence of floats) : the x coordinates of the datapoints
+        vals (sequence of sequences of floats) : the val of every channel, a
+            row per datapoint
+        '''
+        self._history.insertBatch(xs, vals)
+
+    def save(self, path):
+        '''
+        Writes the datapoints to a file, see SortedArrayHistory.save
+
+        path (str) : file path
+        '''
+        self._history.save(path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Opens a file written by save(), see SortedArrayHistory.load
+
+        path (str) : file path
+        mmap (bool) : whether to map the file read only, rather than read it
+        returns (MultiChannelLinearStreamingInterpolator) : interpolator object
+        '''
+        history = SortedArrayHistory.load(path, mmap)
+        if history.getNumChannels() is None:
+            raise ValueError('%s does not hold multi-channel datapoints' % path)
+        return cls(history.getNumChannels(), history)
+
+    def getInterpolatedVal(self, x, channels=None):
+        '''
+        Get the interpolated values of the channels for the given x
+
+        x (float) : the x coordinate of the datapoint
+        channels (int, slice or sequence of ints) : the channels to interpolate,
+            all of them by default
+        returns (numpy.ndarray) : interpolated value of each channel
+        '''
+        if self._history.is_empty() or self._isExpired(x):
+            return None
+
+        keys, vals = self._history.keys(), self._history.values()
+        if channels is not None:
+            vals = vals[:, channels]
+        value = _interpolateSorted(keys, vals, x)
+        # copied, as the vals of a datapoint are a view of the history
+        return value.copy() if vals.ndim == 2 else value
+
+    def getInterpolatedVals(self, xs, channels=None):
+        '''
+        Get the interpolated values of the channels for a whole batch of x
+        coordinates in one pass
+
+        xs (list of floats or numpy.ndarray) : the x coordinates of the datapoints
+        channels (int, slice or sequence of ints) : the channels to interpolate,
+            all of them by default
+        returns (numpy.ndarray) : interpolated values, a row per x and a column
+            per channel, nan where a bounded history's expiredPolicy gives no value
+        '''
+        if self._history.is_empty():
+            return None
+
+        keys, vals = self._history.keys(), self._history.values()
+        if channels is not None:
+            vals = vals[:, channels]
+        xs = numpy.asarray(xs, dtype=float)
+        expired = self._isExpired(xs)[:, None] if vals.ndim == 2 else self._isExpired(xs)
+        return numpy.where(expired, numpy.nan, _interpolateSorted(keys, vals, xs))
+
+
+class ConcurrentLinearStreamingInterpolator(StreamingInterpolatorBase):
+    '''
+    Linear streaming interpolator that can be inserted into from one thread and
+    queried from many others at the same time. Readers never take a lock: they
+    interpolate on an immutable snapshot of sorted arrays, which is replaced by
+    a single reference assignment when new datapoints are published.
+
+    Inserts are only queued, and are merged into a new snapshot in one batch at
+    most publishInterval seconds later by a background thread (or straight away
+    by publish). Datapoints that arrive in increasing x order are appended to
+    the spare capacity of the arrays after the current snapshot, which no
+    snapshot can see, so publishing them costs O(batch) rather than O(n).
+
+    The background thread only holds a weak reference to the interpolator, so
+    an interpolator that is dropped without close is still garbage collected,
+    and its thread then stops
+    '''
+
+    def __init__(self, publishInterval=0.01, maxPending=65536):
+        '''
+        publishInterval (float) : most seconds an insert waits to be visible to
+            queries, or None to publish only when publish is called
+        maxPending (int) : most queued inserts, after which insert publishes
+            them itself rather than wait for the background thread
+        '''
+        # (xs, vals) read only arrays, only ever replaced as a whole
+        self._snapshot = (numpy.empty(0), numpy.empty(0))
+        # buffers the snapshot is a prefix of
+        self._xsBuffer = numpy.empty(16)
+        self._valsBuffer = numpy.empty(16)
+        self._pendingXs = []
+        self._pendingVals = []
+        self._maxPending = maxPending
+        # guards the pending lists
+        self._lock = threading.Lock()
+        # lets only one thread write to the buffers at a time
+        self._publishLock = threading.Lock()
+        self._closed = threading.Event()
+        self._publisher = None
+        if publishInterval is not None:
+            self._publisher = threading.Thread(
+                target=self._publishPeriodically,
+                args=(weakref.ref(self), self._closed, publishInterval))
+            self._publisher.daemon = True
+            self._publisher.start()
+            # wake the thread up to stop once the interpolator is collected
+            weakref.finalize(self, self._closed.set)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.close()
+
+    def close(self):
+        ''' Publish the queued inserts and stop the background thread '''
+        self._closed.set()
+        if self._publisher is not None:
+            self._publisher.join()
+        self.publish()
+
+    @staticmethod
+    def _publishPeriodically(interpolatorRef, closed, publishInterval):
+        '''
+        Publish every publishInterval seconds until closed is set or the
+        interpolator is garbage collected, holding it only while publishing
+
+        interpolatorRef (weakref.ref) : reference to the interpolator
+        closed (threading.Event) : set to stop publishing
+        publishInterval (float) : seconds between publishes
+        '''
+        while not closed.wait(publishInterval):
+            interpolator = interpolatorRef()
+            if interpolator is None:
+                return
+            interpolator.publish()
+            del interpolator
+
+    def insert(self, x, val):
+        '''
+        Register a datapoint, which queries see once it is published
+
+        x (float) : the x coordinate of the datapoint
+        val (float): the rest of the datapoint
+        '''
+        with self._lock:
+            self._pendingXs.append(x)
+            self._pendingVals.append(val)
+            isFull = len(self._pendingXs) >= self._maxPending
+        if isFull:
+            self.publish()
+
+    def insertBatch(self, xs, vals):
+        '''
+        Register a batch of datapoints, which queries see once it is published
+
+        xs (sequence of floats) : the x coordinates of the datapoints
+        vals (sequence of floats) : the rest of the datapoints
+        '''
+        with self._lock:
+            self._pendingXs.extend(xs)
+            self._pendingVals.extend(vals)
+            isFull = len(self._pendingXs) >= self._maxPending
+        if isFull:
+            self.publish()
+
+    def publish(self):
+        ''' Make every datapoint inserted so far visible to queries '''
+        with self._publishLock:
+            with self._lock:
+                pendingXs, self._pendingXs = self._pendingXs, []
+                pendingVals, self._pendingVals = self._pendingVals, []
+            if not pendingXs:
+                return
+
+            # sort the batch, keeping the last val inserted for each x
+            newXs = numpy.array(pendingXs, dtype=float)
+            newVals = numpy.array(pendingVals, dtype=float)
+            order = numpy.argsort(newXs, kind='mergesort')
+            newXs, newVals = newXs[order], newVals[order]
+            isLast = numpy.append(newXs[1:] != newXs[:-1], True)
+            newXs, newVals = newXs[isLast], newVals[isLast]
+
+            xs, vals = self._snapshot
+            size = len(xs) + len(newXs)
+            if len(xs) and newXs[0] <= xs[-1]:
+                # merge into new buffers, so the current snapshot stays intact
+                self._xsBuffer, self._valsBuffer, size = _mergeSorted(
+                    xs, vals, newXs, newVals, max(16, 2 * size))
+            else:
+                if size > len(self._xsBuffer):
+                    for name in ('_xsBuffer', '_valsBuffer'):
+                        grown = numpy.empty(max(2 * len(getattr(self, name)), size))
+                        grown[:len(xs)] = getattr(self, name)[:len(xs)]
+                        setattr(self, name, grown)
+                self._xsBuffer[len(xs):size] = newXs
+                self._valsBuffer[len(xs):size] = newVals
+
+            xs, vals = self._xsBuffer[:size], self._valsBuffer[:size]
+            xs.flags.writeable = False
+            vals.flags.writeable = False
+            self._snapshot = (xs, vals)
+
+    def getSnapshot(self):
+        '''
+        returns (numpy.ndarray, numpy.ndarray) : read only sorted x coordinates
+            and vals of the published datapoints
+        '''
+        return self._snapshot
+
+    def getInterpolatedVal(self, x):
+        '''
+        Get the interpolated value for the given x from the published datapoints
+
+        x (float) : the x coordinate of the datapoint
+        returns (float) : interpolated value
+        '''
+        keys, vals = self._snapshot
+        if not len(keys):
+            return None
+        return float(_interpolateSorted(keys, vals, x))
+
+    def getInterpolatedVals(self, xs):
+        '''
+        Get the interpolated values for a whole batch of x coordinates in one
+        pass, all from the same published datapoints
+
+        xs (list of floats or numpy.ndarray) : the x coordinates of the datapoints
+        returns (numpy.ndarray) : interpolated values
+        '''
+        keys, vals = self._snapshot
+        if not len(keys):
+            return None
+        return _interpolateSorted(keys, vals, numpy.asarray(xs, dtype=float))
+
+
+class CubicHermiteStreamingInterpolatorBase(StreamingInterpolatorBase):
+    '''
+    Abstract base class for piecewise cubic Hermite streaming interpolators.
+    Every datapoint keeps the slope of the curve at it next to its val, and a
+    slope only depends on the datapoints at most two positions away, so an
+    insert recomputes the slopes of at most five datapoints instead of refitting
+    the whole curve. A query is a bracket lookup plus the evaluation of the one
+    cubic between the bracketing datapoints. x coordinates outside the
+    datapoints get the val of the closest datapoint, like
+    LinearStreamingInterpolator
+    '''
+    __metaclass__ = ABCMeta
 
     def __init__(self):
+        # x -> [val, slope]
         self._history = AVLTree()
 
+    @abstractmethod
+    def _getInteriorSlope(self, leftLength, leftSecant, rightLength, rightSecant):
+        '''
+        Get the slope at a datapoint with a neighbor on each side
+
+        leftLength (float) : distance to the neighbor on the left
+        leftSecant (float) : slope of the line from the neighbor on the left
+        rightLength (float) : distance to the neighbor on the right
+        rightSecant (float) : slope of the line to the neighbor on the right
+        returns (float) : slope of the curve at the datapoint
+        '''
+        return
+
+    @abstractmethod
+    def _getEndSlope(self, length, secant, nextLength, nextSecant):
+        '''
+        Get the slope at the first or last of three or more datapoints, looking
+        inwards from it
+
+        length (float) : distance to the closest datapoint
+        secant (float) : slope of the line to the closest datapoint
+        nextLength (float) : distance from the closest datapoint to the next one
+        nextSecant (float) : slope of the line between those two
+        returns (float) : slope of the curve at the datapoint
+        '''
+        return
+
     def insert(self, x, val):
         '''
         Register a datapoint
@@ -89,7 +1059,54 @@ class NearestNeighborStreamingInterpolator(StreamingInterpolatorBase):
         x (float) : the x coordinate of the datapoint
         val (float): the rest of the datapoint
         '''
-        self._history.insert(x, val)
+        self._history.insert(x, [val, 0.])
+
+        # the slopes that can change are within two datapoints of x
+        keys = [x]
+        for step in (self._history.prev_item, self._history.succ_item):
+            key = x
+            for _ in range(2):
+                try:
+                    key = step(key)[0]
+                except KeyError:
+                    break
+                keys.append(key)
+        for key in keys:
+            self._history[key][1] = self._getSlope(key)
+
+    def _getSlope(self, x):
+        '''
+        Get the slope of the curve at a datapoint from its neighbors
+
+        x (float) : the x coordinate of the datapoint
+        returns (float) : slope of the curve at the datapoint
+        '''
+        val = self._history[x][0]
+        neighbors = []
+        for step in (self._history.prev_item, self._history.succ_item):
+            try:
+                neighbors.append(step(x))
+            except KeyError:
+                neighbors.append(None)
+        left, right = neighbors
+
+        if left is None and right is None:
+            return 0.
+        if left is not None and right is not None:
+            leftLength, rightLength = x - left[0], right[0] - x
+            return self._getInteriorSlope(leftLength, (val - left[1][0]) / leftLength,
+                                          rightLength, (right[1][0] - val) / rightLength)
+
+        # at an end, look two datapoints inwards, or one if that is all there is
+        step = self._history.succ_item if left is None else self._history.prev_item
+        closestX, (closestVal, _) = left or right
+        secant = (closestVal - val) / (closestX - x)
+        try:
+            nextX, (nextVal, _) = step(closestX)
+        except KeyError:
+            return secant
+        return self._getEndSlope(abs(closestX - x), secant, abs(nextX - closestX),
+                                 (nextVal - closestVal) / (nextX - closestX))
 
     def getInterpolatedVal(self, x):
         '''
@@ -101,6 +1118,101 @@ class NearestNeighborStreamingInterpolator(StreamingInterpolatorBase):
         if self._history.is_empty():
             return None
 
+        # check if on edge
+        if x <= self._history.min_key():
+            return self._history.min_item()[1][0]
+        if x >= self._history.max_key():
+            return self._history.max_item()[1][0]
+
+        leftX, (leftVal, leftSlope) = self._history.floor_item(x)
+        if leftX == x:
+            return leftVal
+        rightX, (rightVal, rightSlope) = self._history.ceiling_item(x)
+
+        # evaluate the cubic Hermite basis on the enclosing interval
+        length = rightX - leftX
+        t = (x - leftX) / length
+        return ((1 + 2 * t) * (1 - t) ** 2 * leftVal + t * (1 - t) ** 2 * length * leftSlope
+                + t ** 2 * (3 - 2 * t) * rightVal + t ** 2 * (t - 1) * length * rightSlope)
+
+
+class CubicStreamingInterpolator(CubicHermiteStreamingInterpolatorBase):
+    '''
+    Cubic 1D Streaming Interpolator. The slope at each datapoint is that of the
+    parabola through it and its two neighbors, which makes the curve smooth
+    (continuous first derivative) and exact for quadratic data. Unlike a natural
+    cubic spline, whose coefficients all depend on every datapoint, this keeps
+    each insert local
+    '''
+
+    def _getInteriorSlope(self, leftLength, leftSecant, rightLength, rightSecant):
+        return ((rightLength * leftSecant + leftLength * rightSecant)
+                / (leftLength + rightLength))
+
+    def _getEndSlope(self, length, secant, nextLength, nextSecant):
+        return (((2 * length + nextLength) * secant - length * nextSecant)
+                / (length + nextLength))
+
+
+class PchipStreamingInterpolator(CubicHermiteStreamingInterpolatorBase):
+    '''
+    Monotone (PCHIP) 1D Streaming Interpolator. The slopes are picked as in
+    Fritsch and Butland's method, so the curve never overshoots the datapoints:
+    it is monotone wherever the data is, and flat at every local extremum. Gives
+    the same values as scipy.interpolate.PchipInterpolator on the same datapoints
+    '''
+
+    def _getInteriorSlope(self, leftLength, leftSecant, rightLength, rightSecant):
+        if leftSecant * rightSecant <= 0:
+            return 0.
+        # weighted harmonic mean of the secants
+        leftWeight = 2 * rightLength + leftLength
+        rightWeight = rightLength + 2 * leftLength
+        return ((leftWeight + rightWeight)
+                / (leftWeight / leftSecant + rightWeight / rightSecant))
+
+    def _getEndSlope(self, length, secant, nextLength, nextSecant):
+        # one sided three point estimate, limited so the end stays monotone
+        slope = (((2 * length + nextLength) * secant - length * nextSecant)
+                 / (length + nextLength))
+        if numpy.sign(slope) != numpy.sign(secant):
+            return 0.
+        if numpy.sign(secant) != numpy.sign(nextSecant) and abs(slope) > abs(3 * secant):
+            return 3 * secant
+        return slope
+
+
+# for more than 1 dimension, see KDTreeStreamingInterpolator
+class NearestNeighborStreamingInterpolator(StreamingInterpolatorBase):
+    ''' Nearest Neighbor 1D Streaming Interpolator '''
+
+    def __init__(self, history=None):
+        '''
+        history (AVLTree or SortedArrayHistory) : storage for the datapoints, an
+            empty AVLTree by default. SortedArrayHistory is much faster when the
+            datapoints mostly arrive in increasing x order
+        '''
+        self._history = history if history is not None else AVLTree()
+
+    def insert(self, x, val):
+        '''
+        Register a datapoint
+
+        x (float) : the x coordinate of the datapoint
+        val (float): the rest of the datapoint
+        '''
+        self._history.insert(x, val)
+
+    def getInterpolatedVal(self, x):
+        '''
+        Get the interpolated value for the given x
+
+        x (float) : the x coordinate of the datapoint
+        returns (float) : interpolated value
+        '''
+        if self._history.is_empty() or self._isExpired(x):
+            return None
+
         # find the nearest point to the left and right
         leftX, leftVal = None, None
         rightX, rightVal = None, None
@@ -120,3 +1232,166 @@ class NearestNeighborStreamingInterpolator(StreamingInterpolatorBase):
             return leftVal
         else:
             return rightVal
+
+
+class KDTreeStreamingInterpolator(StreamingInterpolatorBase):
+    '''
+    Nearest Neighbor Streaming Interpolator for points of any dimension, backed
+    by a kdtree. With k > 1 the value is the inverse distance weighted average
+    of the k nearest datapoints (more in case of equal distances), and a query
+    at a datapoint gives its val.
+
+    The tree is kept balanced the way a scapegoat tree is: when an insert lands
+    deeper than log(n) / log(1 / alpha), the subtree of the lowest ancestor on
+    its path that is out of alpha weight balance is rebuilt around medians.
+    Rebuilds cost O(log(n)) amortized per insert, and keep queries logarithmic
+    even when the points arrive in sorted order, or all share a coordinate
+    '''
+
+    def __init__(self, dimensions, k=1, power=2, alpha=0.7):
+        '''
+        dimensions (int) : number of coordinates of every point
+        k (int) : number of nearest datapoints to interpolate between
+        power (float) : weights are 1 / distance ** power
+        alpha (float) : in (0.5, 1), how unbalanced a subtree may get before it
+            is rebuilt. Smaller is more balanced but rebuilds more often
+        '''
+        if k < 1:
+            raise ValueError('k must be at least 1')
+        if not 0.5 < alpha < 1:
+            raise ValueError('alpha must be between 0.5 and 1')
+        self._dimensions = dimensions
+        self._k = k
+        self._power = power
+        self._alpha = alpha
+        self._tree = kdtree.create(dimensions=dimensions)
+        # point -> val
+        self._history = {}
+
+    def insert(self, x, val):
+        '''
+        Register a datapoint
+
+        x (sequence of floats) : the coordinates of the datapoint
+        val (float): the rest of the datapoint
+        '''
+        point = tuple(x)
+        if len(point) != self._dimensions:
+            raise ValueError('x must have %d coordinates' % self._dimensions)
+        isNew = point not in self._history
+        self._history[point] = val
+        if not isNew:
+            return
+
+        if self._tree.data is None:
+            self._tree.add(point)
+            return
+
+        # go down the tree as add does, remembering the path
+        path = [self._tree]
+        while True:
+            node = path[-1]
+            child = node.left if point[node.axis] < node.data[node.axis] else node.right
+            if child is None or child.data is None:
+                break
+            path.append(child)
+        path.append(self._tree.add(point))
+
+        maxDepth = math.log(len(self._history)) / math.log(1 / self._alpha)
+        if len(path) - 1 > maxDepth:
+            self._rebuildScapegoat(path, maxDepth)
+
+    def _rebuildScapegoat(self, path, maxDepth):
+        '''
+        Rebuild the subtree of the lowest node on the path whose larger child
+        holds more than alpha of its points, and which is high enough up for
+        the rebuilt subtree to end halfway between a perfectly balanced tree
+        and maxDepth. Rebuilding a lower one would barely lower the new leaf,
+        and points arriving in sorted order would rebuild again straight away
+
+        path (list of kdtree.KDNode) : nodes from the root to a new leaf
+        maxDepth (float) : the most edges from the root to any leaf
+        '''
+        targetDepth = (maxDepth + math.log(len(self._history), 2)) / 2
+        size = 1
+        for depth in range(len(path) - 2, -1, -1):
+            node, child = path[depth], path[depth + 1]
+            sibling = node.right if child is node.left else node.left
+            siblingSize = sum(1 for _ in sibling.inorder()) if sibling else 0
+            childSize, size = size, size + siblingSize + 1
+            # a subtree built around medians is size.bit_length() - 1 deep
+            if (max(childSize, siblingSize) > self._alpha * size
+                    and depth + size.bit_length() - 1 <= targetDepth):
+                break
+
+        subtree = self._build([n.data for n in node.inorder()], node.axis, node.sel_axis)
+        if depth == 0:
+            self._tree = subtree
+        else:
+            parent = path[depth - 1]
+            parent.set_child(0 if parent.left is node else 1, subtree)
+
+    def _build(self, points, axis, selAxis):
+        '''
+        Build a subtree around medians like kdtree.create, with two differences:
+        the split is on the next axis the points differ along when they all
+        share the coordinate of the given one, and the median is moved to the
+        edge of a run of equal coordinates, so that every point left of a node
+        is smaller along its axis, as add expects. Then points that share a
+        coordinate are still split evenly
+
+        points (list of tuples) : the points, which get reordered
+        axis (int) : axis to split the points on
+        selAxis (function) : gives the axis of the children from the axis of
+            their parent
+        returns (kdtree.KDNode) : root of the subtree, or None for no points
+        '''
+        if not points:
+            return None
+        for _ in range(self._dimensions):
+            points.sort(key=lambda point: point[axis])
+            if points[0][axis] != points[-1][axis]:
+                break
+            axis = (axis + 1) % self._dimensions
+
+        # split before or after the run of coordinates equal to the median's,
+        # whichever is closer to the middle
+        median = len(points) // 2
+        first, last = median, median + 1
+        while first > 0 and points[first - 1][axis] == points[median][axis]:
+            first -= 1
+        while last < len(points) and points[last][axis] == points[median][axis]:
+            last += 1
+        if last < len(points) and last - median < median - first:
+            median = last
+        else:
+            median = first
+
+        return kdtree.KDNode(points[median],
+                             self._build(points[:median], selAxis(axis), selAxis),
+                             self._build(points[median + 1:], selAxis(axis), selAxis),
+                             axis=axis, sel_axis=selAxis, dimensions=self._dimensions)
+
+    def _dist(self, a, b):
+        return math.sqrt(sum((ai - bi) ** 2 for ai, bi in zip(a, b)))
+
+    def getInterpolatedVal(self, x):
+        '''
+        Get the interpolated value for the given x
+
+        x (sequence of floats) : the coordinates of the datapoint
+        returns (float) : interpolated value
+        '''
+        if not self._history:
+            return None
+
+        point = tuple(x)
+        if point in self._history:
+            return self._history[point]
+
+        # the euclidean (rather than the default squared) distance is what the
+        # tree's pruning compares with coordinate differences
+        neighbors = self._tree.search_knn(point, self._k, dist=self._dist)
+        weights = [dist ** -self._power for _, dist in neighbors]
+        return (sum(w * self._history[node.data] for w, (node, _) in zip(weights, neighbors))
+                / sum(weights))